@@ -1,12 +1,27 @@
 from django.contrib import admin
-from .models import Hook, Task
+from .models import Hook, Task, MediaProbe
+from .tools.job_queue import get_queue
 
 # Register your models here.
 @admin.register(Hook)
 class HookAdmin(admin.ModelAdmin):
     list_display = ['hooks_content', 'google_sheets_link',
-                    'eleven_labs_api_key', 'voice_id']
+                    'eleven_labs_api_key', 'voice_id', 'render_backend']
     
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ['task_id', 'status', 'video_links']
\ No newline at end of file
+    list_display = ['task_id', 'status', 'stage', 'progress_summary', 'checkpoint_summary',
+                    'progress_updated_at', 'video_links']
+    readonly_fields = ['progress_updated_at']
+    actions = ['resume_tasks']
+
+    @admin.action(description='Resume selected failed tasks')
+    def resume_tasks(self, request, queryset):
+        queue = get_queue('hooks')
+        resumed = sum(queue.requeue(task_id) for task_id in queryset.values_list('task_id', flat=True))
+        self.message_user(request, f'{resumed} tasks requeued.')
+
+@admin.register(MediaProbe)
+class MediaProbeAdmin(admin.ModelAdmin):
+    list_display = ['path', 'width', 'height', 'frame_rate', 'video_codec', 'pix_fmt',
+                    'duration', 'keyframes', 'audio_codec', 'audio_layout']
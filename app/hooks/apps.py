@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class HooksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'hooks'
+
+    def ready(self):
+        from .tools.job_queue import register_queue
+        register_queue('hooks', self.get_model('Task'), 'hooks.views.run_hook_task',
+                       'hooks.tools.checkpoints.cleanup_work_dirs')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from hooks.tools.checkpoints import cleanup_work_dirs
+
+
+class Command(BaseCommand):
+    help = 'Delete the working directories of hook tasks older than their retention.'
+
+    def handle(self, *args, **options):
+        deleted = cleanup_work_dirs()
+        for task_id in deleted:
+            self.stdout.write(f'{task_id} deleted')
+        self.stdout.write(self.style.SUCCESS(f'{len(deleted)} working directories deleted'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from hooks.models import Task
+from hooks.tools.job_queue import get_queue
+
+
+class Command(BaseCommand):
+    help = 'Put failed hook tasks back in the queue. Hooks finished before the failure are not redone.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('task_ids', nargs='*', help='Task ids to resume.')
+        parser.add_argument('--all-failed', action='store_true',
+                            help='Resume every failed task that has checkpoints.')
+
+    def handle(self, *args, **options):
+        task_ids = options['task_ids']
+        if options['all_failed']:
+            task_ids += list(Task.objects.filter(status='failed', checkpoints__isnull=False)
+                             .values_list('task_id', flat=True))
+        elif not task_ids:
+            raise CommandError('Give task ids or --all-failed.')
+
+        queue = get_queue('hooks')
+        for task_id in task_ids:
+            if queue.requeue(task_id):
+                self.stdout.write(self.style.SUCCESS(f'{task_id} requeued'))
+            else:
+                self.stdout.write(self.style.WARNING(f'{task_id} is not a failed task, skipped'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from hooks.tools.job_queue import create_worker_pool
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of workers that process queued hook and merge tasks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker threads (defaults to JOB_QUEUE_WORKERS).')
+
+    def handle(self, *args, **options):
+        pool = create_worker_pool(options['workers'])
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f'{pool.size} workers started, press CTRL-C to stop.'))
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            pool.stop()
@@ -1,4 +1,5 @@
 from django.db import models
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
 def validate_video_file(value):
@@ -18,19 +19,110 @@ class Hook(models.Model):
     font_color = models.CharField(max_length=7, default='#FFFFFF')
     task_id = models.CharField(max_length=1000, unique=True)
     parallel_processing = models.BooleanField(default=False)
+    render_backend = models.CharField(max_length=20, choices=[('moviepy', 'MoviePy'), ('ffmpeg', 'FFmpeg')], default='moviepy')
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return str(self.id)
 
-class Task(models.Model):
-    task_id = models.CharField(max_length=255)
+class QueuedJob(models.Model):
+    # Fields used by hooks.tools.job_queue to lease the row to a worker
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    enqueued_at = models.DateTimeField(null=True, blank=True)
+    leased_by = models.CharField(max_length=255, blank=True, default='')
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class Task(QueuedJob):
+    task_id = models.CharField(max_length=255, db_index=True)
     status = models.CharField(max_length=20, default='processing')
     video_links = models.JSONField(null=True, blank=True)
+    # Written in batches by hooks.tools.progress.TaskProgress
+    stage = models.CharField(max_length=20, blank=True, default='')
+    progress = models.JSONField(null=True, blank=True)
+    progress_updated_at = models.DateTimeField(null=True, blank=True)
+    # Per hook checkpoints written by hooks.tools.checkpoints.TaskCheckpoints
+    checkpoints = models.JSONField(null=True, blank=True)
+
+    def progress_summary(self):
+        if not self.progress:
+            return ''
+        return (f"{self.progress['rendered']}/{self.progress['total']} rendered, "
+                f"{self.progress['voiced']} voiced, {self.progress['failed']} failed")
+
+    def checkpoint_summary(self):
+        if not self.checkpoints:
+            return ''
+        videos = sum(1 for checkpoint in self.checkpoints.values() if checkpoint.get('video_done'))
+        return f"{videos}/{len(self.checkpoints)} videos checkpointed"
+
+    def status_payload(self):
+        # Returned by check_task_status and cached by hooks.tools.status_cache
+        return {
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'video_links': self.video_links if self.status == 'completed' else None
+        }
     
     def __str__(self) -> str:
         return self.status
 
+class MediaProbe(models.Model):
+    # Stream metadata of a video file, filled in by hooks.tools.media_probe
+    content_key = models.CharField(max_length=64, unique=True)
+    path = models.CharField(max_length=1000)
+    size = models.PositiveBigIntegerField()
+    mtime = models.FloatField()
+    video_codec = models.CharField(max_length=50, blank=True, default='')
+    video_profile = models.CharField(max_length=50, blank=True, default='')
+    pix_fmt = models.CharField(max_length=50, blank=True, default='')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    frame_rate = models.CharField(max_length=20, blank=True, default='')
+    fps = models.FloatField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+    keyframes = models.PositiveIntegerField(null=True, blank=True)
+    audio_codec = models.CharField(max_length=50, blank=True, default='')
+    audio_channels = models.PositiveIntegerField(null=True, blank=True)
+    audio_layout = models.CharField(max_length=50, blank=True, default='')
+    audio_sample_rate = models.PositiveIntegerField(null=True, blank=True)
+    probed_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def has_audio(self):
+        return bool(self.audio_codec or self.audio_channels or self.audio_sample_rate)
+
+    @property
+    def keyframe_interval(self):
+        if not self.keyframes or not self.duration:
+            return None
+        return self.duration / self.keyframes
+
+    def as_infos(self):
+        # Same keys as moviepy's ffmpeg_parse_infos, for the hooks renderers
+        return {
+            'duration': self.duration,
+            'video_size': [self.width, self.height],
+            'video_fps': self.fps,
+            'audio_found': self.has_audio,
+        }
+
+    def stream_params(self):
+        # Parameters concatenated parts must share, for the merger
+        return {
+            'width': self.width,
+            'height': self.height,
+            'fps': self.frame_rate or '30/1',
+            'has_audio': self.has_audio,
+        }
+
+    def __str__(self):
+        return f'{self.path} ({self.width}x{self.height} {self.video_codec})'
+
 class Package(models.Model):
     name = models.CharField(max_length=100)
     price = models.PositiveIntegerField()
@@ -1,3 +1,719 @@
-from django.test import TestCase
+import io
+import multiprocessing
+import os
+import re
+import subprocess
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from moviepy.config import get_setting
+from PIL import Image
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .models import Task
+from .tools.audio_processors import ElevenLabsClient
+from .tools.checkpoints import TaskCheckpoints, cleanup_work_dirs, task_work_dir
+from .tools.cpu_budget import ThreadBudget, get_budget
+from .tools.scheduler import RenderScheduler
+from .tools.file_serving import parse_range, sendfile_location, serve_file
+from .tools.streaming_zip import stream_zip, zip_response
+from .tools.spreadsheet_extractor import (build_word_color_index, prewarm_google_sheet, prewarm_key,
+                                          take_prewarmed_sheet)
+from .tools import ingest
+from .tools.job_queue import JobQueue
+from .tools.manifest import build_manifest
+from .tools.overlay_cache import OverlayCache
+from .tools.status_cache import get_status
+from .tools.video_processors import get_text_overlay
+
+AUDIO_CHUNK = b'\xff\xfb' + b'\x00' * 1022
+
+
+class StubTTSHandler(BaseHTTPRequestHandler):
+    # The voice id in the path selects the behaviour: ok, paused, error or slow
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        voice_id = self.path.rsplit('/', 1)[-1]
+        if voice_id == 'error':
+            self._send(401, b'{"detail": {"status": "invalid_api_key"}}')
+        elif voice_id == 'slow':
+            self.server.release.wait(5)
+            self._send(200, AUDIO_CHUNK)
+        elif voice_id == 'paused':
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.send_header('Content-Length', str(len(AUDIO_CHUNK) * 2))
+            self.end_headers()
+            self.wfile.write(AUDIO_CHUNK)
+            self.wfile.flush()
+            self.server.first_chunk_sent.set()
+            self.server.release.wait(5)
+            self.wfile.write(AUDIO_CHUNK)
+        else:
+            self._send(200, AUDIO_CHUNK * 4)
+
+    def _send(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client already gave up on this request
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ElevenLabsClientTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubTTSHandler)
+        cls.server.daemon_threads = True
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.server_thread.start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.first_chunk_sent = threading.Event()
+        self.server.release = threading.Event()
+        self.addCleanup(self.server.release.set)
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.save_path = os.path.join(self.folder, 'hook_1.mp3')
+        self.client = ElevenLabsClient('key', base_url=self.base_url, concurrency=2, timeout=(2, 0.5))
+
+    def test_saves_streamed_audio(self):
+        self.client.text_to_speech('Hello', self.save_path, 'ok')
+
+        with open(self.save_path, 'rb') as f:
+            self.assertEqual(f.read(), AUDIO_CHUNK * 4)
+        self.assertFalse(os.path.exists(f'{self.save_path}.part'))
+
+    def test_streams_into_part_file_before_renaming(self):
+        errors = []
+
+        def request():
+            try:
+                self.client.text_to_speech('Hello', self.save_path, 'paused')
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        self.assertTrue(self.server.first_chunk_sent.wait(5))
+        # Mid stream only the .part file exists
+        for _ in range(50):
+            if os.path.exists(f'{self.save_path}.part'):
+                break
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(f'{self.save_path}.part'))
+        self.assertFalse(os.path.exists(self.save_path))
+
+        self.server.release.set()
+        thread.join(5)
+        self.assertEqual(errors, [])
+        with open(self.save_path, 'rb') as f:
+            self.assertEqual(f.read(), AUDIO_CHUNK * 2)
+        self.assertFalse(os.path.exists(f'{self.save_path}.part'))
+
+    def test_error_status_raises(self):
+        with self.assertRaisesMessage(Exception, 'status code 401'):
+            self.client.text_to_speech('Hello', self.save_path, 'error')
+        self.assertEqual(os.listdir(self.folder), [])
+
+    def test_read_timeout_raises(self):
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.client.text_to_speech('Hello', self.save_path, 'slow')
+        self.assertFalse(os.path.exists(self.save_path))
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_byte_ranges(self):
+        self.assertEqual(parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range('bytes=500-', 1000), (500, 999))
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range('bytes=900-5000', 1000), (900, 999))
+
+    def test_ignored_ranges_send_the_whole_file(self):
+        self.assertIsNone(parse_range('bytes=10-5', 1000))
+        self.assertIsNone(parse_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(parse_range('items=0-1', 1000))
+
+    def test_unsatisfiable_ranges(self):
+        with self.assertRaises(ValueError):
+            parse_range('bytes=1000-', 1000)
+        with self.assertRaises(ValueError):
+            parse_range('bytes=-0', 1000)
+
+
+@override_settings(SENDFILE_HEADER=None)
+class ServeFileTests(SimpleTestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = os.path.join(folder, 'hook_0.mp4')
+        with open(self.path, 'wb') as f:
+            f.write(bytes(range(100)))
+        self.factory = RequestFactory()
+
+    def test_download_is_an_attachment(self):
+        response = serve_file(self.factory.get('/'), self.path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="hook_0.mp4"')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+
+    def test_range_request(self):
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=10-19'), self.path)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+    def test_invalid_and_unsatisfiable_ranges(self):
+        self.assertEqual(serve_file(self.factory.get('/', HTTP_RANGE='bytes=10-5'), self.path).status_code, 200)
+        response = serve_file(self.factory.get('/', HTTP_RANGE='bytes=100-'), self.path)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_not_modified(self):
+        etag = serve_file(self.factory.get('/'), self.path)['ETag']
+        response = serve_file(self.factory.get('/', HTTP_IF_NONE_MATCH=etag), self.path)
+        self.assertEqual(response.status_code, 304)
+
+
+class StreamZipTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.files = []
+        for idx, size in enumerate((0, 10, 3000)):
+            path = os.path.join(self.folder, f'hook_{idx}.mp4')
+            with open(path, 'wb') as f:
+                f.write(os.urandom(size))
+            self.files.append((path, f'hook_{idx}.mp4'))
+
+    def read_archive(self, chunks):
+        return zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+
+    def test_archive_contains_every_file(self):
+        chunks = list(stream_zip(self.files, chunk_size=1024))
+        # The 3000 byte file is streamed in several chunks
+        self.assertGreater(len(chunks), 3)
+        archive = self.read_archive(chunks)
+        self.assertIsNone(archive.testzip())
+        for path, name in self.files:
+            with open(path, 'rb') as f:
+                self.assertEqual(archive.read(name), f.read())
+            self.assertEqual(archive.getinfo(name).compress_type, zipfile.ZIP_STORED)
+
+    def test_missing_files_are_skipped(self):
+        files = self.files + [(os.path.join(self.folder, 'missing.mp4'), 'missing.mp4')]
+        archive = self.read_archive(stream_zip(files))
+        self.assertEqual(archive.namelist(), [name for _, name in self.files])
+
+    def test_response_runs_on_complete(self):
+        completed = []
+        response = zip_response(self.files, 'final_videos.zip', on_complete=lambda: completed.append(True))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="final_videos.zip"')
+        self.assertEqual(completed, [])
+        self.read_archive(response.streaming_content)
+        self.assertEqual(completed, [True])
+
+
+def failing_handler(job):
+    raise Exception('render failed')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'task_status': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}},
+    JOB_QUEUE_LEASE_SECONDS=60, JOB_QUEUE_MAX_ATTEMPTS=2)
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue('hooks', Task, 'hooks.tests.failing_handler')
+        for task_id in ('first', 'second'):
+            Task.objects.create(task_id=task_id)
+            self.assertTrue(self.queue.enqueue(task_id))
+
+    def test_enqueue_only_once(self):
+        self.assertFalse(self.queue.enqueue('first'))
+
+    def test_lease_oldest_job_once(self):
+        job = self.queue.lease('worker-1')
+        self.assertEqual(job.task_id, 'first')
+        self.assertEqual((job.status, job.leased_by, job.attempts), ('processing', 'worker-1', 1))
+        self.assertEqual(self.queue.lease('worker-2').task_id, 'second')
+        self.assertIsNone(self.queue.lease('worker-3'))
+
+    def test_requeue_expired(self):
+        job = self.queue.lease('worker-1')
+        Task.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.queue.requeue_expired()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.leased_by, job.lease_expires_at), ('queued', '', None))
+
+        # The second expiry uses up JOB_QUEUE_MAX_ATTEMPTS
+        self.queue.lease('worker-1')
+        Task.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.queue.requeue_expired()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_live_leases_are_kept(self):
+        job = self.queue.lease('worker-1')
+        self.queue.requeue_expired()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.leased_by), ('processing', 'worker-1'))
+
+    def test_failed_job_can_be_requeued(self):
+        job = self.queue.lease('worker-1')
+        self.assertFalse(self.queue.requeue(job.task_id))
+        self.queue.run(job, 'worker-1')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.leased_by), ('failed', ''))
+
+        self.assertTrue(self.queue.requeue(job.task_id))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 0))
+        self.assertEqual(get_status(Task, job.task_id)['status'], 'queued')
+
+
+def _die_while_encoding(budget, started):
+    with budget.encode():
+        started.set()
+        # Killed mid encode: the finally that returns the threads never runs
+        os._exit(1)
+
+
+class ThreadBudgetTests(SimpleTestCase):
+
+    def test_share_follows_demand(self):
+        budget = ThreadBudget(8)
+        with budget.encode() as threads:
+            self.assertEqual(threads, 8)
+        self.assertEqual(budget.available, 8)
+
+        budget.add_demand(4)
+        with budget.encode(expected=True) as threads:
+            self.assertEqual(threads, 2)
+            self.assertEqual(budget.available, 6)
+        budget.add_demand(-4)
+        self.assertEqual((budget.available, budget.demand), (8, 0))
+
+    def test_encodes_wait_when_the_total_is_reserved(self):
+        budget = ThreadBudget(4)
+        granted = []
+
+        def second_encode():
+            with budget.encode() as threads:
+                granted.append(threads)
+
+        with budget.encode() as first:
+            self.assertEqual(first, 4)
+            thread = threading.Thread(target=second_encode)
+            thread.start()
+            thread.join(0.2)
+            # Nothing is left, the second encode waits instead of oversubscribing
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(budget.demand, 2)
+        thread.join(5)
+        self.assertEqual(granted, [4])
+        self.assertEqual(budget.available, 4)
+
+    def test_threads_of_dead_processes_are_reclaimed(self):
+        ctx = multiprocessing.get_context('fork')
+        budget = ThreadBudget(4)
+        started = ctx.Event()
+        process = ctx.Process(target=_die_while_encoding, args=(budget, started))
+        process.start()
+        self.assertTrue(started.wait(5))
+        process.join(5)
+        self.assertEqual(budget.available, 0)
+
+        self.assertEqual(budget.reclaim(), 4)
+        self.assertEqual(budget.available, 4)
+
+
+class PrewarmedSheetTests(SimpleTestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        caches_setting = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'sheets': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': folder},
+        }
+        override = override_settings(CACHES=caches_setting, SHEETS_CACHE='sheets')
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_prewarmed_sheet_is_taken_once(self):
+        sheet = {'values': [['Hook one']], 'word_color_data': [[]]}
+        link = 'https://docs.google.com/spreadsheets/d/abc/edit'
+        with mock.patch('hooks.tools.spreadsheet_extractor.fetch_google_sheet', return_value=sheet):
+            prewarm_google_sheet(link)
+
+        # A separate cache handler reads the same files, as the worker process would
+        worker_cache = FileBasedCache(settings.CACHES['sheets']['LOCATION'], {})
+        self.assertIsNotNone(worker_cache.get(prewarm_key(link)))
+        self.assertEqual(take_prewarmed_sheet(f' {link} '), sheet)
+        self.assertIsNone(take_prewarmed_sheet(link))
+
+
+def _render_or_die(job):
+    if job == 3:
+        # A render process killed by the OS, e.g. out of memory
+        os._exit(1)
+    time.sleep(0.05)
+    return job * 2
+
+
+class RenderSchedulerTests(SimpleTestCase):
+
+    def test_broken_pool_fails_its_jobs_and_continues(self):
+        executors = []
+
+        def new_executor():
+            executor = ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('fork'))
+            executors.append(executor)
+            return executor
+
+        results, errors = {}, {}
+        scheduler = RenderScheduler(new_executor(), 2, executor_factory=new_executor)
+        finished = scheduler.run(range(1, 9), _render_or_die,
+                                 on_result=lambda job, result: results.__setitem__(job, result),
+                                 on_error=lambda job, err: errors.__setitem__(job, err))
+        for executor in executors:
+            executor.shutdown()
+
+        self.assertTrue(finished)
+        self.assertIsInstance(errors[3], BrokenProcessPool)
+        self.assertEqual(len(results) + len(errors), 8)
+        self.assertEqual(results[8], 16)
+        self.assertGreater(len(executors), 1)
+        self.assertEqual(get_budget().demand, 0)
+
+
+class SendfileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.path = os.path.join(self.work_dir, 'task_abc', 'output', 'videos', 'hook_0.mp4')
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'video')
+        self.factory = RequestFactory()
+
+    def test_hook_outputs_are_mapped_to_an_internal_location(self):
+        with override_settings(HOOKS_WORK_DIR=self.work_dir,
+                               SENDFILE_INTERNAL_LOCATIONS={self.work_dir: '/protected/hooks'}):
+            self.assertEqual(sendfile_location(self.path), '/protected/hooks/task_abc/output/videos/hook_0.mp4')
+
+    def test_x_accel_redirect_offloads_the_download(self):
+        with override_settings(SENDFILE_HEADER='X-Accel-Redirect',
+                               SENDFILE_INTERNAL_LOCATIONS={self.work_dir: '/protected/hooks/'}):
+            response = serve_file(self.factory.get('/'), self.path)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/hooks/task_abc/output/videos/hook_0.mp4')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="hook_0.mp4"')
+        self.assertEqual(response.content, b'')
+
+    def test_files_outside_the_locations_are_served_from_python(self):
+        with override_settings(SENDFILE_HEADER='X-Accel-Redirect', SENDFILE_INTERNAL_LOCATIONS={}):
+            response = serve_file(self.factory.get('/'), self.path)
+        self.assertFalse(response.has_header('X-Accel-Redirect'))
+        self.assertEqual(b''.join(response.streaming_content), b'video')
+
+    def test_work_dir_is_offloaded_by_default(self):
+        self.assertIn(settings.HOOKS_WORK_DIR, settings.SENDFILE_INTERNAL_LOCATIONS)
+
+
+class OverlayCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache = OverlayCache(self.cache_dir, max_memory_entries=4, max_disk_entries=4)
+        self.rgba = np.zeros((4, 6, 4), dtype=np.uint8)
+        self.rgba[..., 3] = 255
+
+    def test_memory_hit_marks_the_png_as_used(self):
+        entry = self.cache.put('key', self.rgba, [2, 2])
+        os.utime(entry.path, (0, 0))
+        self.assertIs(self.cache.get('key'), entry)
+        self.assertGreater(os.path.getmtime(entry.path), 0)
+
+    def test_memory_hit_rewrites_a_png_evicted_by_another_process(self):
+        entry = self.cache.put('key', self.rgba, [2, 2])
+        os.remove(entry.path)
+        self.assertIs(self.cache.get('key'), entry)
+        self.assertTrue(np.array_equal(np.array(Image.open(entry.path)), self.rgba))
+
+
+class TaskCheckpointsTests(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+        self.audios_folder = os.path.join(self.work_dir, 'audios')
+        self.videos_folder = os.path.join(self.work_dir, 'videos')
+        os.makedirs(self.audios_folder)
+        os.makedirs(self.videos_folder)
+        Task.objects.create(task_id='resume', status='processing')
+
+    def first_attempt(self, manifest, rendered):
+        # Runs until the crash: every hook voiced, the `rendered` ones rendered
+        checkpoints = TaskCheckpoints('resume')
+        for record in manifest:
+            audio_filename = f'hook_{record.idx}.mp3'
+            with open(os.path.join(self.audios_folder, audio_filename), 'wb') as f:
+                f.write(b'audio')
+            checkpoints.audio_done(record, 'voice', audio_filename)
+        for record in manifest[:rendered]:
+            output_path = os.path.join(self.videos_folder, record.hook_video_filename)
+            with open(output_path, 'wb') as f:
+                f.write(b'video %d' % record.idx)
+            checkpoints.video_done(record, output_path)
+        return checkpoints
+
+    def test_restore_after_a_crash(self):
+        self.first_attempt(build_manifest([['One'], ['Two'], ['Three']]), rendered=2)
+
+        manifest = build_manifest([['One'], ['Two'], ['Three']])
+        self.assertEqual(TaskCheckpoints('resume').restore(manifest, self.audios_folder), 2)
+        self.assertEqual([record.status for record in manifest], ['rendered', 'rendered', 'pending'])
+        self.assertEqual(manifest[2].audio_filename, 'hook_2.mp3')
+        self.assertEqual(manifest[0].output_path, os.path.join(self.videos_folder, 'hook_0.mp4'))
+
+    def test_restore_skips_corrupted_and_missing_files(self):
+        self.first_attempt(build_manifest([['One'], ['Two']]), rendered=2)
+        with open(os.path.join(self.videos_folder, 'hook_0.mp4'), 'wb') as f:
+            f.write(b'video X')
+        os.remove(os.path.join(self.audios_folder, 'hook_1.mp3'))
+
+        manifest = build_manifest([['One'], ['Two']])
+        self.assertEqual(TaskCheckpoints('resume').restore(manifest, self.audios_folder), 1)
+        self.assertEqual(manifest[0].status, 'pending')
+        self.assertEqual(manifest[0].audio_filename, 'hook_0.mp3')
+        self.assertEqual(manifest[1].status, 'rendered')
+        self.assertEqual(manifest[1].audio_filename, '')
+
+    def test_restore_skips_hooks_whose_text_changed(self):
+        self.first_attempt(build_manifest([['One'], ['Two']]), rendered=2)
+
+        manifest = build_manifest([['One'], ['Changed']])
+        self.assertEqual(TaskCheckpoints('resume').restore(manifest, self.audios_folder), 1)
+        self.assertEqual(manifest[1].status, 'pending')
+        self.assertEqual(manifest[1].audio_filename, '')
+
+    def test_resumed_task_does_not_charge_hooks_twice(self):
+        manifest = build_manifest([['One'], ['Two'], ['Three']])
+        checkpoints = self.first_attempt(manifest, rendered=2)
+        checkpoints.mark_charged(manifest[:2])
+
+        manifest = build_manifest([['One'], ['Two'], ['Three']])
+        checkpoints = TaskCheckpoints('resume')
+        checkpoints.restore(manifest, self.audios_folder)
+        self.assertEqual([checkpoints.is_charged(record) for record in manifest], [True, True, False])
+
+        # Rendering the last hook keeps the charged flags of the others
+        output_path = os.path.join(self.videos_folder, manifest[2].hook_video_filename)
+        with open(output_path, 'wb') as f:
+            f.write(b'video 2')
+        checkpoints.video_done(manifest[2], output_path)
+        self.assertEqual([checkpoints.is_charged(record) for record in manifest], [True, True, False])
+        self.assertTrue(TaskCheckpoints('resume').is_charged(manifest[0]))
+
+    def test_charge_does_not_carry_over_to_a_new_hook_text(self):
+        manifest = build_manifest([['One']])
+        self.first_attempt(manifest, rendered=1).mark_charged(manifest)
+
+        self.assertFalse(TaskCheckpoints('resume').is_charged(build_manifest([['Other']])[0]))
+
+
+class CleanupWorkDirsTests(TestCase):
+
+    def setUp(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        settings_override = override_settings(HOOKS_WORK_DIR=work_dir, HOOKS_WORK_DIR_RETENTION=100,
+                                              HOOKS_FAILED_WORK_DIR_RETENTION=1000)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_work_dir(self, task_id, status, age):
+        if status is not None:
+            Task.objects.create(task_id=task_id, status=status)
+        path = os.path.join(task_work_dir(task_id), 'output', 'videos', 'hook_0.mp4')
+        os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'video')
+        modified = time.time() - age
+        for root in (path, os.path.dirname(path), os.path.dirname(os.path.dirname(path)), task_work_dir(task_id)):
+            os.utime(root, (modified, modified))
+
+    def test_retention_depends_on_the_task_status(self):
+        self.make_work_dir('completed_old', 'completed', 200)
+        self.make_work_dir('completed_new', 'completed', 10)
+        self.make_work_dir('failed_resumable', 'failed', 200)
+        self.make_work_dir('failed_old', 'failed', 2000)
+        self.make_work_dir('orphaned', None, 2000)
+        self.make_work_dir('running', 'processing', 2000)
+        self.make_work_dir('queued', 'queued', 2000)
+
+        self.assertCountEqual(cleanup_work_dirs(), ['completed_old', 'failed_old', 'orphaned'])
+        remaining = sorted(os.listdir(settings.HOOKS_WORK_DIR))
+        self.assertEqual(remaining, ['task_completed_new', 'task_failed_resumable', 'task_queued', 'task_running'])
+
+    def test_a_recent_write_keeps_the_directory(self):
+        self.make_work_dir('failed', 'failed', 2000)
+        with open(os.path.join(task_work_dir('failed'), 'output', 'videos', 'hook_1.mp4'), 'wb') as f:
+            f.write(b'video')
+
+        self.assertEqual(cleanup_work_dirs(), [])
+
+    def test_missing_work_dir(self):
+        with override_settings(HOOKS_WORK_DIR=os.path.join(settings.HOOKS_WORK_DIR, 'missing')):
+            self.assertEqual(cleanup_work_dirs(), [])
+
+
+def sheet_cell(*words):
+    return [{'text': text, 'color': color} for text, color in words]
+
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+
+class WordColorIndexTests(SimpleTestCase):
+
+    def test_parts_around_the_dash_are_aligned_separately(self):
+        row = [sheet_cell(('hello', RED), ('world', BLACK), ('-', BLACK), ('buy', GREEN), ('NOW', WHITE))]
+        self.assertEqual(build_word_color_index(row, 'hello world - buy now'), [
+            [('Hello', '#ff0000'), ('World', '#000000')],
+            [('Buy', '#00ff00'), ('Now', '#ffffff')],
+        ])
+
+    def test_words_are_matched_in_order_across_cells(self):
+        row = [sheet_cell(('the', RED), ('best', BLACK)), None, sheet_cell(('the', GREEN))]
+        self.assertEqual(build_word_color_index(row, 'the best the'),
+                         [[('The', '#ff0000'), ('Best', '#000000'), ('The', '#00ff00')]])
+
+    def test_underscores_are_ignored(self):
+        # The processor removes the underscores of the hook text before building the index
+        row = [sheet_cell(('fast_er', RED), ('deals', GREEN))]
+        self.assertEqual(build_word_color_index(row, 'faster deals'),
+                         [[('Faster', '#ff0000'), ('Deals', '#00ff00')]])
+
+    def test_words_missing_from_the_row_have_no_color(self):
+        row = [sheet_cell(('big', RED), ('sale', GREEN))]
+        self.assertEqual(build_word_color_index(row, 'big summer sale - today'), [
+            [('Big', '#ff0000'), ('Summer', None), ('Sale', '#00ff00')],
+            [('Today', None)],
+        ])
+        self.assertEqual(build_word_color_index(None, 'big sale'), [[('Big', None), ('Sale', None)]])
+
+
+class TextOverlayColorTests(SimpleTestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = OverlayCache(cache_dir, max_memory_entries=4, max_disk_entries=4)
+        patcher = mock.patch('hooks.tools.video_processors.get_overlay_cache', return_value=cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('hooks.tools.video_processors.render_text_overlay',
+                             return_value=(np.zeros((2, 2, 4), dtype=np.uint8), [1, 1]))
+        self.render = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def word_colors(self, hook_text, word_color_index):
+        get_text_overlay(hook_text, 360, 640, (72, 90, 255), (10, 20, 30), 20, word_color_index)
+        pango_text, pango_text2 = self.render.call_args.args[:2]
+        return [re.findall(r'foreground="(#[0-9a-f]{6})">(\w+)<', text or '') for text in (pango_text, pango_text2)]
+
+    def test_default_colors_replace_black_first_and_white_second_part(self):
+        index = [[('Hello', '#000000'), ('World', '#ff0000')], [('Buy', '#ffffff'), ('Now', None)]]
+        self.assertEqual(self.word_colors('hello world - buy now', index), [
+            [('#0a141e', 'Hello'), ('#ff0000', 'World')],
+            [('#000000', 'Buy'), ('#000000', 'Now')],
+        ])
+
+    def test_index_of_another_text_falls_back_to_default_colors(self):
+        index = [[('Hello', '#ff0000'), ('There', '#ff0000')]]
+        self.assertEqual(self.word_colors('hello world - buy now', index), [
+            [('#0a141e', 'Hello'), ('#0a141e', 'World')],
+            [('#000000', 'Buy'), ('#000000', 'Now')],
+        ])
+        self.assertEqual(self.word_colors('hello world', None), [[('#0a141e', 'Hello'), ('#0a141e', 'World')], []])
+
+
+class NormalizeSourcesTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.source_dir = tempfile.mkdtemp()
+        cls.source = os.path.join(cls.source_dir, 'source.mp4')
+        subprocess.run([get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error', '-f', 'lavfi',
+                        '-i', 'testsrc=duration=2:size=320x240:rate=25', '-pix_fmt', 'yuv420p', cls.source],
+                       check=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.source_dir)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.output_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_folder)
+        self.output_file = os.path.join(self.output_folder, 'source.mp4')
+
+    def normalize(self, max_seconds):
+        with mock.patch.object(ingest, 'normalize_source_video', wraps=ingest.normalize_source_video) as encode:
+            paths = ingest.normalize_sources([self.source], self.output_folder, 90, 160, max_seconds)
+        return paths, encode.call_count
+
+    def test_resumed_attempt_reuses_the_normalized_file(self):
+        self.assertEqual(self.normalize(1), ([self.output_file], 1))
+        self.assertEqual(os.listdir(self.output_folder), ['source.mp4'])
+        self.assertEqual(self.normalize(1), ([self.output_file], 0))
+
+    def test_longer_limit_normalizes_again(self):
+        self.normalize(1)
+        self.assertEqual(self.normalize(None), ([self.output_file], 1))
+        self.assertEqual(self.normalize(5), ([self.output_file], 0))
+
+    def test_unreadable_file_is_normalized_again(self):
+        with open(self.output_file, 'wb') as f:
+            f.write(b'truncated')
+        self.assertEqual(self.normalize(1), ([self.output_file], 1))
+        self.assertEqual(self.normalize(1), ([self.output_file], 0))
@@ -1,55 +1,109 @@
 # Utility functions used to process audios
 import os
 import re
+import threading
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from .tts_cache import get_tts_cache
 
 logging.basicConfig(level=logging.DEBUG)
 
-def text_to_speech_file(api_key, text: str, save_file_path: str, voice_id: str, remove_punctuation: bool = True) -> bool:
-    if remove_punctuation:
-        text = text.replace('-', ' ').replace('"', ' ').replace("'", ' ')
-        text = re.sub(r'[^\w\s]', '', text)
-
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": api_key
-    }
-    data = {
-        "text": text,
-        "model_id": "eleven_monolingual_v1",
-        "voice_settings": {
-            "stability": 0.5,
-            "similarity_boost": 0.75
+TTS_MODEL_ID = "eleven_monolingual_v1"
+TTS_VOICE_SETTINGS = {
+    "stability": 0.5,
+    "similarity_boost": 0.75
+}
+
+
+class ElevenLabsClient:
+    """
+    Text to speech client that keeps its connections open between requests.
+    `base_url` can point at a local stub server, `concurrency` sizes the
+    connection pool and is the number of rows callers should synthesize at once.
+    """
+
+    def __init__(self, api_key, base_url=None, concurrency=None, timeout=None):
+        self.api_key = api_key
+        self.base_url = (base_url or settings.ELEVENLABS_API_URL).rstrip('/')
+        self.concurrency = concurrency or settings.ELEVENLABS_CONCURRENCY
+        self.timeout = timeout or settings.ELEVENLABS_TIMEOUT
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Accept": "audio/mpeg",
+            "xi-api-key": api_key
+        })
+
+    def text_to_speech(self, text, save_file_path, voice_id, model_id=TTS_MODEL_ID, voice_settings=None):
+        url = f"{self.base_url}/v1/text-to-speech/{voice_id}"
+        data = {
+            "text": text,
+            "model_id": model_id,
+            "voice_settings": voice_settings or TTS_VOICE_SETTINGS
         }
-    }
 
-    response = requests.post(url, json=data, headers=headers)
+        with self.session.post(url, json=data, stream=True, timeout=self.timeout) as response:
+            if response.status_code != 200:
+                logging.error(f"API request failed with status code {response.status_code}: {response.text}")
+                raise Exception(f"API request failed with status code {response.status_code}")
+
+            # Stream into a temp file so a dropped connection never leaves a truncated mp3 behind
+            temp_path = f"{save_file_path}.part"
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if chunk:
+                        f.write(chunk)
+            os.replace(temp_path, save_file_path)
 
-    if response.status_code != 200:
-        logging.error(f"API request failed with status code {response.status_code}: {response.text}")
-        raise Exception(f"API request failed with status code {response.status_code}")
+        return save_file_path
 
-    with open(save_file_path, 'wb') as f:
-        for chunk in response.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_tts_client(api_key):
+    """Returns the shared client for an API key so every row reuses the same connection pool."""
+    with _clients_lock:
+        if api_key not in _clients:
+            _clients[api_key] = ElevenLabsClient(api_key)
+        return _clients[api_key]
+
+def clean_tts_text(text):
+    text = text.replace('-', ' ').replace('"', ' ').replace("'", ' ')
+    return re.sub(r'[^\w\s]', '', text)
+
+def text_to_speech_file(api_key, text: str, save_file_path: str, voice_id: str, remove_punctuation: bool = True) -> bool:
+    if remove_punctuation:
+        text = clean_tts_text(text)
+
+    get_tts_client(api_key).text_to_speech(text, save_file_path, voice_id)
     return True, voice_id
 
-def process_audios(api_key, row, hook_number, hook_text, input_df, idx, output_audios_folder, voice_id):
-    print(voice_id)
-    if row['Audio Filename'] in (None, '') or not os.path.exists(os.path.join(output_audios_folder, row['Audio Filename'])):
+def process_audios(api_key, audio_filename, hook_number, hook_text, output_audios_folder, voice_id):
+    """
+    Generates the voiceover of a hook unless audio_filename already exists in
+    output_audios_folder. Returns (voice, audio file name), both empty when
+    the voiceover could not be generated.
+    """
+    if audio_filename and os.path.exists(os.path.join(output_audios_folder, audio_filename)):
+        return voice_id, audio_filename
+    else:
         logging.info(f"Generating voiceover for hook {hook_number}...")
         audio_filename = os.path.join(output_audios_folder, f'hook_{hook_number}.mp3')
-        # import pdb;pdb.set_trace()
         try:
-            status, voice_name = text_to_speech_file(api_key, hook_text, audio_filename, voice_id)
-            row['Voice'] = voice_name
-            row['Audio Filename'] = os.path.basename(audio_filename)
-            input_df.at[idx, 'Voice'] = voice_name
-            input_df.at[idx, 'Audio Filename'] = row['Audio Filename']
+            # Identical text and voice settings were synthesized before, reuse that file
+            tts_cache = get_tts_cache()
+            cache_key = tts_cache.make_key(voice_id, TTS_MODEL_ID, TTS_VOICE_SETTINGS, clean_tts_text(hook_text))
+            if tts_cache.fetch(cache_key, audio_filename):
+                voice_name = voice_id
+            else:
+                status, voice_name = text_to_speech_file(api_key, hook_text, audio_filename, voice_id)
+                tts_cache.store(cache_key, audio_filename)
+            return voice_name, os.path.basename(audio_filename)
         except Exception as err:
             logging.error(f"Failed to hook audio file --> {audio_filename} --> {str(err)}", exc_info=True)
+            return '', ''
@@ -0,0 +1,156 @@
+# Durable per hook checkpoints of a task, so a restarted task only redoes unfinished hooks
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from hooks.models import Task
+from .utils import delete_temp_dir
+
+logging.basicConfig(level=logging.DEBUG)
+
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+
+
+def task_work_dir(task_id):
+    """Working directory of a task, the same on every attempt so its files survive a restart."""
+    return os.path.join(settings.HOOKS_WORK_DIR, f'task_{task_id}')
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def text_key(hook_text):
+    # A checkpoint is only valid for the hook text it was made from, the sheet may change between attempts
+    return hashlib.sha1(hook_text.encode('utf-8')).hexdigest()
+
+def _last_modified(path):
+    latest = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                pass
+    return latest
+
+def cleanup_work_dirs(now=None):
+    """
+    Deletes task working directories that are no longer needed, measured from
+    their last write. Completed tasks keep theirs for HOOKS_WORK_DIR_RETENTION,
+    their downloads are served from it. Failed tasks, which can still be
+    resumed, and directories without a task keep theirs for
+    HOOKS_FAILED_WORK_DIR_RETENTION. Queued and running tasks are skipped.
+    Returns the ids of the deleted directories' tasks.
+    """
+    now = now or time.time()
+    try:
+        names = os.listdir(settings.HOOKS_WORK_DIR)
+    except FileNotFoundError:
+        return []
+    task_ids = [name[len('task_'):] for name in names if name.startswith('task_')]
+    statuses = dict(Task.objects.filter(task_id__in=task_ids).values_list('task_id', 'status'))
+
+    deleted = []
+    for task_id in task_ids:
+        status = statuses.get(task_id)
+        if status == 'completed':
+            retention = settings.HOOKS_WORK_DIR_RETENTION
+        elif status in ('failed', None):
+            retention = settings.HOOKS_FAILED_WORK_DIR_RETENTION
+        else:
+            continue
+        work_dir = task_work_dir(task_id)
+        try:
+            if now - _last_modified(work_dir) < retention:
+                continue
+        except OSError:
+            continue
+        # Checkpoints stay, restore() skips files that are gone and the charged hooks are still known
+        delete_temp_dir(work_dir)
+        deleted.append(task_id)
+    if deleted:
+        logging.info(f"Deleted the working directories of {len(deleted)} tasks")
+    return deleted
+
+
+class TaskCheckpoints:
+    """
+    Records in Task.checkpoints, keyed by hook index, when a hook's
+    voiceover and video are done, with the video's path, size and sha256.
+    Every checkpoint is written as soon as it is reached, losing one would
+    cost a TTS request or a render.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.hooks = Task.objects.filter(task_id=task_id).values_list('checkpoints', flat=True).first() or {}
+        self._lock = threading.Lock()
+
+    def restore(self, manifest, audios_folder):
+        """
+        Fills in the records whose checkpointed files still exist and match.
+        Records with a verified video are marked 'rendered', returns how many.
+        """
+        restored = 0
+        for record in manifest:
+            checkpoint = self.hooks.get(str(record.idx))
+            if not checkpoint or checkpoint.get('text') != text_key(record.hook_text):
+                continue
+            audio_filename = checkpoint.get('audio_filename')
+            if audio_filename and os.path.exists(os.path.join(audios_folder, audio_filename)):
+                record.voice = checkpoint.get('voice', '')
+                record.audio_filename = audio_filename
+            if checkpoint.get('video_done') and self._video_intact(checkpoint):
+                record.output_path = checkpoint['output_path']
+                record.status = 'rendered'
+                restored += 1
+        logging.info(f"Task {self.task_id}: {restored}/{len(manifest)} hooks restored from checkpoints")
+        return restored
+
+    def _video_intact(self, checkpoint):
+        path = checkpoint.get('output_path')
+        try:
+            if not path or os.path.getsize(path) != checkpoint.get('size'):
+                return False
+            return file_checksum(path) == checkpoint.get('checksum')
+        except OSError:
+            return False
+
+    def audio_done(self, record, voice, audio_filename):
+        self._save(record, voice=voice, audio_filename=audio_filename, audio_done=True,
+                   video_done=False, output_path='', size=None, checksum='')
+
+    def video_done(self, record, output_path):
+        self._save(record, video_done=True, output_path=output_path,
+                   size=os.path.getsize(output_path), checksum=file_checksum(output_path))
+
+    def is_charged(self, record):
+        checkpoint = self.hooks.get(str(record.idx), {})
+        return bool(checkpoint.get('charged')) and checkpoint.get('text') == text_key(record.hook_text)
+
+    def mark_charged(self, records):
+        """Records that the user paid for these hooks, in one write."""
+        with self._lock:
+            for record in records:
+                self.hooks.setdefault(str(record.idx), {})['charged'] = True
+            Task.objects.filter(task_id=self.task_id).update(checkpoints=self.hooks)
+
+    def _save(self, record, **fields):
+        with self._lock:
+            key = text_key(record.hook_text)
+            checkpoint = self.hooks.get(str(record.idx))
+            if checkpoint is None or checkpoint.get('text') != key:
+                # New hook text, nothing of the old checkpoint applies
+                checkpoint = self.hooks[str(record.idx)] = {'text': key}
+            checkpoint.update(fields)
+            try:
+                Task.objects.filter(task_id=self.task_id).update(checkpoints=self.hooks)
+            except Exception as e:
+                logging.warning(f"Failed to save checkpoint of hook {record.hook_number} of task {self.task_id}: {e}")
@@ -0,0 +1,143 @@
+# Budget of encoder threads shared by hook renders, merge jobs and source ingest
+import logging
+import multiprocessing
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logging.basicConfig(level=logging.DEBUG)
+
+# Seconds a waiting encode sleeps before checking for threads held by dead processes
+RECLAIM_INTERVAL = 5
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # A killed child that was not reaped yet still has a pid
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return True
+
+
+class ThreadBudget:
+    """
+    Hands every ffmpeg/x264 encode an explicit thread count. Left alone each
+    encode starts one thread per core, so a handful of concurrent encodes
+    oversubscribes the machine.
+
+    An encode reserves its share of `total_threads` and returns it when it
+    ends, waiting while none are free. The share is the total divided by the
+    live demand: encodes running or waiting plus the renders the scheduler
+    has in flight, so a lone merge gets every core and a full render window
+    one thread each. Counters and reservations live in shared memory and are
+    handed to the render worker processes, so renders, merges and ingest of a
+    worker draw from one total. Reservations are recorded per pid; threads
+    held by a process that died without returning them are reclaimed.
+    """
+
+    def __init__(self, total_threads):
+        self.total_threads = max(1, total_threads)
+        ctx = multiprocessing.get_context('spawn')
+        self._available = ctx.RawValue('i', self.total_threads)
+        self._demand = ctx.RawValue('i', 0)
+        # (pid, threads) pairs, a reservation holds at least one thread so total_threads slots suffice
+        self._reservations = ctx.RawArray('i', 2 * self.total_threads)
+        self._changed = ctx.Condition()
+
+    @property
+    def available(self):
+        return self._available.value
+
+    @property
+    def demand(self):
+        return self._demand.value
+
+    def add_demand(self, count):
+        """Announces encodes that are about to start elsewhere, e.g. renders submitted to worker processes."""
+        with self._changed:
+            self._demand.value = max(0, self._demand.value + count)
+            self._changed.notify_all()
+
+    def share(self):
+        return max(1, self.total_threads // max(1, self._demand.value))
+
+    @contextmanager
+    def encode(self, expected=False):
+        """
+        Reserves threads for one encode. `expected` encodes were already
+        counted with add_demand() by whoever started them.
+        """
+        with self._changed:
+            if not expected:
+                self._demand.value += 1
+            while self._available.value < 1:
+                if not self._changed.wait(RECLAIM_INTERVAL):
+                    self._reclaim()
+            threads = min(self.share(), self._available.value)
+            self._available.value -= threads
+            slot = self._reserve(os.getpid(), threads)
+        try:
+            yield threads
+        finally:
+            with self._changed:
+                self._reservations[slot * 2] = 0
+                self._reservations[slot * 2 + 1] = 0
+                self._available.value += threads
+                if not expected:
+                    self._demand.value = max(0, self._demand.value - 1)
+                self._changed.notify_all()
+
+    def _reserve(self, pid, threads):
+        for slot in range(self.total_threads):
+            if self._reservations[slot * 2] == 0:
+                self._reservations[slot * 2] = pid
+                self._reservations[slot * 2 + 1] = threads
+                return slot
+        raise RuntimeError('No free reservation slot in the thread budget')
+
+    def _reclaim(self):
+        # Called with the condition held
+        reclaimed = 0
+        for slot in range(self.total_threads):
+            pid = self._reservations[slot * 2]
+            if pid and not _pid_alive(pid):
+                reclaimed += self._reservations[slot * 2 + 1]
+                self._reservations[slot * 2] = 0
+                self._reservations[slot * 2 + 1] = 0
+        if reclaimed:
+            self._available.value += reclaimed
+            logging.warning(f'Reclaimed {reclaimed} encoder threads held by dead processes')
+            self._changed.notify_all()
+        return reclaimed
+
+    def reclaim(self):
+        """Returns the threads of processes that died mid encode, e.g. after the render pool broke."""
+        with self._changed:
+            return self._reclaim()
+
+
+_budget = None
+_budget_lock = threading.Lock()
+
+def configure_budget(budget):
+    """Installs the parent's budget in a render worker process."""
+    global _budget
+    with _budget_lock:
+        _budget = budget
+    return _budget
+
+def get_budget():
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = ThreadBudget(settings.ENCODE_THREADS_TOTAL or os.cpu_count() or 1)
+        return _budget
@@ -0,0 +1,106 @@
+# Renders hook videos with a single ffmpeg filtergraph instead of moviepy
+import logging
+import os
+import subprocess
+import time
+
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from .video_processors import compute_crop_box, get_text_overlay
+from .source_pool import get_source_pool
+from .cpu_budget import get_budget
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def build_filtergraph(sources, each_video_duration, out_width, out_height, fps):
+    """
+    Builds the trim/crop/scale/concat/overlay filtergraph. `sources` is a list of
+    (width, height) tuples in input order, the overlay image is the input after them.
+    """
+    filters = []
+    labels = []
+    for i, (width, height) in enumerate(sources):
+        chain = [f'trim=duration={each_video_duration:.6f}', 'setpts=PTS-STARTPTS']
+        # Normalized sources already have the output size, only trim them
+        if (width, height) != (out_width, out_height):
+            x1, y1, x2, y2 = compute_crop_box(width, height, out_width, out_height)
+            chain.append(f'crop={x2 - x1}:{y2 - y1}:{x1}:{y1}')
+            if (x2 - x1, y2 - y1) != (out_width, out_height):
+                chain.append(f'scale={out_width}:{out_height}')
+        chain += ['setsar=1', f'fps={fps}', 'format=yuv420p']
+        filters.append(f'[{i}:v]' + ','.join(chain) + f'[v{i}]')
+        labels.append(f'[v{i}]')
+
+    filters.append(''.join(labels) + f'concat=n={len(sources)}:v=1:a=0[base]')
+    filters.append(f'[base][{len(sources)}:v]overlay=0:0:format=auto,format=yuv420p[outv]')
+    return ';'.join(filters)
+
+def render_hook_ffmpeg(job):
+    """
+    Same plan as process_audio_on_videos (split the voiceover duration across the
+    source videos, crop to the output aspect ratio, concatenate, put the text
+    overlay on top and use the voiceover as the only audio track), compiled into
+    one ffmpeg call so frames never go through Python.
+    """
+    idx = job['idx']
+    width, height = job['width'], job['height']
+    output_videos_folder = job['output_videos_folder']
+
+    audio_duration = ffmpeg_parse_infos(job['audio_path'])['duration']
+    num_videos_to_use = job['num_videos_to_use']
+    if num_videos_to_use <= 0:
+        logging.error(f"num_videos_to_use is 0 or less for hook {job['hook_number']}, setting it to 1 to avoid division by zero.")
+        num_videos_to_use = 1
+    each_video_duration = audio_duration / num_videos_to_use
+
+    # Sources are probed once per task, not once per hook
+    source_pool = get_source_pool(job['task_id'])
+    video_files = []
+    sources = []
+    fps = None
+    for considered_vid in job['video_files']:
+        if not os.path.exists(considered_vid):
+            logging.error(f"Video file {considered_vid} does not exist.")
+            continue
+        infos = source_pool.probe(considered_vid)
+        video_files.append(considered_vid)
+        sources.append(tuple(infos['video_size']))
+        # moviepy keeps the highest frame rate when concatenating, do the same
+        fps = max(fps or 0, infos['video_fps'])
+
+    if not video_files:
+        logging.error("No valid video clips were found for concatenation.")
+        return None
+
+    cleaned_hook_text = job['hook_text'].replace('_', '')
+    auto_font_size = max(int(width / len(cleaned_hook_text) * 1.5), 20)
+    # The cached overlay PNG is used as is, it is never re-rendered or copied
+    overlay = get_text_overlay(cleaned_hook_text, width, height, job['top_box_color'],
+                               job['default_text_color'], auto_font_size, job['word_color_index'])
+
+    ffmpeg_binary = get_setting('FFMPEG_BINARY')
+    output_video_filename = os.path.join(output_videos_folder, f'hook_{idx}.mp4')
+    command = [ffmpeg_binary, '-y', '-loglevel', 'error']
+    for video_file in video_files:
+        command += ['-i', video_file]
+    command += ['-loop', '1', '-i', overlay.path, '-i', job['audio_path']]
+    command += [
+        '-filter_complex', build_filtergraph(sources, each_video_duration, width, height, fps),
+        '-map', '[outv]', '-map', f'{len(video_files) + 1}:a',
+        '-t', f'{audio_duration:.6f}',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-r', f'{fps}',
+        '-c:a', 'aac', '-ar', '44100',
+    ]
+
+    logging.info(f'Rendering hook {job["hook_number"]} with ffmpeg')
+    started = time.monotonic()
+    with get_budget().encode(expected=True) as threads:
+        command += ['-threads', str(threads), output_video_filename]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f'ffmpeg failed for hook {job["hook_number"]}: {result.stderr.decode()}')
+
+    logging.info(f'Hook {job["hook_number"]} rendered in {time.monotonic() - started:.1f}s')
+    return output_video_filename
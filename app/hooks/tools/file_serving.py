@@ -0,0 +1,128 @@
+# Serves output videos with Range, conditional GET and front proxy offload support
+import logging
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, quote_etag
+
+logging.basicConfig(level=logging.DEBUG)
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(stat):
+    return quote_etag(f'{stat.st_size:x}-{stat.st_mtime_ns:x}')
+
+def parse_range(range_header, size):
+    """
+    Returns the (start, end) byte offsets, end inclusive, of a single range
+    Range header. None means the header is ignored and the whole file is
+    sent, ValueError means the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if match is None:
+        # Multiple ranges or other units, answering with the whole file is allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(range_header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # Syntactically invalid (last before first), the header is ignored
+        return None
+    if start >= size:
+        raise ValueError(range_header)
+    end = min(int(last), size - 1) if last else size - 1
+    return start, end
+
+def sendfile_location(path):
+    """Internal proxy location of a file for X-Accel-Redirect, None when it is not exposed."""
+    real_path = os.path.realpath(path)
+    for folder, location in settings.SENDFILE_INTERNAL_LOCATIONS.items():
+        folder = os.path.realpath(folder)
+        if real_path.startswith(folder + os.sep):
+            return location.rstrip('/') + '/' + os.path.relpath(real_path, folder).replace(os.sep, '/')
+    return None
+
+def _read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def serve_file(request, path, content_type='video/mp4', as_attachment=True):
+    """
+    Sends a file, answering Range requests with 206 and If-None-Match with
+    304. When SENDFILE_HEADER is set the transfer is handed to the front
+    proxy, which then also takes care of ranges.
+    """
+    if not os.path.isfile(path):
+        return HttpResponse("Video not found", status=404)
+
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+    }
+    file_name = os.path.basename(path)
+    if as_attachment:
+        headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    header = settings.SENDFILE_HEADER
+    if header == 'X-Sendfile':
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response[header] = path
+        return response
+    if header == 'X-Accel-Redirect':
+        location = sendfile_location(path)
+        if location is not None:
+            response = HttpResponse(content_type=content_type, headers=headers)
+            response[header] = location
+            return response
+        logging.warning(f"{path} is outside SENDFILE_INTERNAL_LOCATIONS, serving it from Python")
+
+    # If-Range: a stale validator gets the whole file instead of a partial one
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416, headers=headers)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(_read_range(path, start, end), status=206,
+                                             content_type=content_type, headers=headers)
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = str(end - start + 1)
+            return response
+
+    # FileResponse sets Content-Disposition itself and would replace the one in headers
+    headers.pop('Content-Disposition', None)
+    return FileResponse(open(path, 'rb'), as_attachment=as_attachment, filename=file_name,
+                        content_type=content_type, headers=headers)
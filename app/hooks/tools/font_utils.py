@@ -1,55 +1,108 @@
 # Utility functions used to process fonts
 import logging
-import tempfile
 import os
-import subprocess
+import threading
 
-logging.basicConfig(level=logging.basicConfig)
+from PIL import ImageFont
+from django.conf import settings
 
-def setup_fontconfig(font_path):
-    # Step 1: Create a temporary directory
-    temp_dir = tempfile.mkdtemp()
-    logging.info(f"Created temporary directory at {temp_dir}")
+logging.basicConfig(level=logging.DEBUG)
 
-    # Step 2: Prepare the Fontconfig configuration content
-    fontconfig_content = f"""<?xml version="1.0"?>
-<!DOCTYPE fontconfig SYSTEM "fonts.dtd">
-<fontconfig>
-    <dir>{os.path.dirname(font_path)}</dir>
+# Family name used in the Pango markup of the hook text overlays
+MU_FONT = 'Mu Font'
+FONT_EXTENSIONS = ('.otf', '.ttf')
+
+
+class FontRegistry:
+    """
+    Knows every font in dependencies/fonts and points Fontconfig at them.
+    The fonts.conf file and the Fontconfig cache live in `config_dir` and are
+    shared by all worker processes, so the setup runs once per process instead
+    of once per rendered overlay.
+    """
+
+    def __init__(self, fonts_dir, config_dir, aliases=None):
+        self.fonts_dir = os.path.abspath(fonts_dir)
+        self.config_dir = os.path.abspath(config_dir)
+        self.aliases = aliases or {}
+        self.fonts = {}
+        self.config_path = os.path.join(self.config_dir, 'fonts.conf')
+
+    def scan(self):
+        for file_name in sorted(os.listdir(self.fonts_dir)):
+            if not file_name.lower().endswith(FONT_EXTENSIONS):
+                continue
+            font_path = os.path.join(self.fonts_dir, file_name)
+            try:
+                family, style = ImageFont.truetype(font_path).getname()
+            except OSError as e:
+                logging.warning(f"Could not read font {font_path}: {e}")
+                continue
+            self.fonts[f'{family} {style}'.lower()] = font_path
+            self.fonts.setdefault(family.lower(), font_path)
+            self.fonts[os.path.splitext(file_name)[0].lower()] = font_path
+        for alias, file_name in self.aliases.items():
+            self.fonts[alias.lower()] = os.path.join(self.fonts_dir, file_name)
+        logging.info(f"Registered {len(self.fonts)} font names from {self.fonts_dir}")
+
+    def lookup(self, name):
+        """Returns the font file for a family name, 'family style', alias or file name."""
+        return self.fonts.get(name.lower())
+
+    def fontconfig_content(self):
+        alias_matches = ''.join(f"""
     <match target="pattern">
         <test name="family" qual="any">
-            <string>Mu Font</string>
+            <string>{alias}</string>
         </test>
         <edit name="family" mode="assign" binding="strong">
-            <string>Mu Font</string>
+            <string>{alias}</string>
         </edit>
         <edit name="file" mode="assign" binding="strong">
-            <string>{font_path}</string>
+            <string>{os.path.join(self.fonts_dir, file_name)}</string>
         </edit>
-    </match>
-</fontconfig>
-"""
-    logging.info("Fontconfig content prepared:")
-    logging.info(fontconfig_content)
-
-    # Step 3: Write the configuration to the temporary directory
-    config_path = os.path.join(temp_dir, "fonts.conf")
-    with open(config_path, "w") as f:
-        f.write(fontconfig_content.strip())  # Ensure no leading/trailing spaces or newlines
-    logging.info(f"Fontconfig written to {config_path}")
-
-    # Step 4: Set the FONTCONFIG_FILE environment variable
-    os.environ["FONTCONFIG_FILE"] = config_path
-    logging.info(f"FONTCONFIG_FILE environment variable set to {config_path}")
-
-    # Step 5: Verify the setup by listing the fonts recognized by Fontconfig
-    result = subprocess.run(['fc-list'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    logging.info("Fontconfig available fonts after setup:")
-    logging.info(result.stdout.decode())
-    
-    # Step 6: Check if any errors were reported
-    if result.stderr:
-        print("Debug: Fontconfig error:")
-        print(result.stderr.decode())
-
-    return temp_dir
\ No newline at end of file
+    </match>""" for alias, file_name in self.aliases.items())
+
+        return f"""<?xml version="1.0"?>
+<!DOCTYPE fontconfig SYSTEM "fonts.dtd">
+<fontconfig>
+    <dir>{self.fonts_dir}</dir>
+    <cachedir>{os.path.join(self.config_dir, 'cache')}</cachedir>{alias_matches}
+</fontconfig>"""
+
+    def install(self):
+        os.makedirs(self.config_dir, exist_ok=True)
+        content = self.fontconfig_content()
+
+        # Other worker processes may be reading the file, only replace it when it changed
+        try:
+            with open(self.config_path) as f:
+                unchanged = f.read() == content
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            temp_path = f'{self.config_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.replace(temp_path, self.config_path)
+            logging.info(f"Fontconfig written to {self.config_path}")
+
+        os.environ["FONTCONFIG_FILE"] = self.config_path
+        logging.info(f"FONTCONFIG_FILE environment variable set to {self.config_path}")
+
+
+_font_registry = None
+_font_registry_lock = threading.Lock()
+
+def get_font_registry():
+    """Returns the process-wide FontRegistry, creating and installing it on first use."""
+    global _font_registry
+    with _font_registry_lock:
+        if _font_registry is None:
+            registry = FontRegistry(os.path.join(settings.BASE_DIR, 'dependencies', 'fonts'),
+                                    settings.HOOKS_FONTCONFIG_DIR,
+                                    aliases={MU_FONT: 'mu.otf'})
+            registry.scan()
+            registry.install()
+            _font_registry = registry
+        return _font_registry
@@ -0,0 +1,107 @@
+# Normalizes the uploaded source videos of a task once, while its voiceovers are generated
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from moviepy.config import get_setting
+
+from .video_processors import compute_crop_box
+from .cpu_budget import get_budget
+from .media_probe import probe_media
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def normalize_source_video(input_file, output_file, out_width, out_height, fps, max_seconds=None):
+    """
+    Crops and scales a source video to the output size and frame rate with a
+    short keyframe interval. Hooks rendered from the result only need to trim
+    and overlay it. Hooks only read the start of a source, so only the first
+    max_seconds are encoded. The file only appears at output_file once it is
+    complete.
+    """
+    width, height = probe_media(input_file).as_infos()['video_size']
+    x1, y1, x2, y2 = compute_crop_box(width, height, out_width, out_height)
+    video_filter = (f'crop={x2 - x1}:{y2 - y1}:{x1}:{y1},scale={out_width}:{out_height},'
+                    f'setsar=1,fps={fps},format=yuv420p')
+
+    # The source audio is never used, the voiceover replaces it
+    command = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error', '-i', input_file,
+               '-vf', video_filter, '-an',
+               *(['-t', str(max_seconds)] if max_seconds else []),
+               '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '16',
+               '-g', str(int(fps // 2) or 1), '-movflags', '+faststart']
+    root, ext = os.path.splitext(output_file)
+    partial_file = f'{root}.partial{ext}'
+    with get_budget().encode() as threads:
+        command += ['-threads', str(threads), partial_file]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f'ffmpeg failed to normalize {input_file}: {result.stderr.decode()}')
+    os.replace(partial_file, output_file)
+    return output_file
+
+def is_normalized(media_probe, out_width, out_height, fps):
+    """
+    True when a source already is what normalization would produce: h264
+    yuv420p at the output size and frame rate, with a keyframe at least every
+    second so trimming it stays cheap.
+    """
+    keyframe_interval = media_probe.keyframe_interval
+    return (media_probe.video_codec == 'h264' and media_probe.pix_fmt == 'yuv420p'
+            and (media_probe.width, media_probe.height) == (out_width, out_height)
+            and media_probe.fps is not None and abs(media_probe.fps - fps) < 0.01
+            and keyframe_interval is not None and keyframe_interval <= 1)
+
+def is_reusable(output_probe, source_probe, out_width, out_height, fps, max_seconds=None):
+    """
+    True when the file an earlier attempt normalized a source to still fits:
+    the output size and frame rate, and at least as long as this attempt would
+    encode. Codec and keyframes are only checked when the probe reports them,
+    the bundled ffmpeg does not.
+    """
+    if output_probe.video_codec and not is_normalized(output_probe, out_width, out_height, fps):
+        return False
+    if ((output_probe.width, output_probe.height) != (out_width, out_height)
+            or output_probe.fps is None or abs(output_probe.fps - fps) >= 0.01):
+        return False
+    needed = min(filter(None, (source_probe.duration, max_seconds)), default=None)
+    if needed is None:
+        return True
+    # The last frame may end up to one frame short of the requested length
+    return output_probe.duration is not None and output_probe.duration >= needed - 1 / fps - 0.05
+
+def normalize_sources(video_paths, output_folder, out_width, out_height, max_seconds=None):
+    """
+    Normalizes every source video and returns the paths hooks should be rendered
+    from, in the same order. A source that fails to normalize is used as is, one
+    normalized by an earlier attempt of the task is reused.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    fps = settings.HOOKS_NORMALIZED_FPS
+
+    def normalize(video_path):
+        # Keep the file name so the manifest still shows the uploaded names
+        output_file = os.path.join(output_folder, os.path.basename(video_path))
+        try:
+            source_probe = probe_media(video_path)
+            if is_normalized(source_probe, out_width, out_height, fps):
+                logging.info(f'Source video {video_path} is already normalized')
+                return video_path
+            if os.path.exists(output_file):
+                try:
+                    if is_reusable(probe_media(output_file), source_probe, out_width, out_height, fps, max_seconds):
+                        logging.info(f'Reusing normalized source video {output_file}')
+                        return output_file
+                except Exception as err:
+                    logging.warning(f'Normalizing {video_path} again, {output_file} is unreadable --> {str(err)}')
+            logging.info(f'Normalizing source video {video_path}')
+            return normalize_source_video(video_path, output_file, out_width, out_height, fps, max_seconds)
+        except Exception as err:
+            logging.error(f'Using {video_path} without normalization --> {str(err)}')
+            return video_path
+
+    with ThreadPoolExecutor(max_workers=min(len(video_paths), os.cpu_count() or 1) or 1) as executor:
+        return list(executor.map(normalize, video_paths))
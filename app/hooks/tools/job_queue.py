@@ -0,0 +1,222 @@
+# Database backed job queue used to run hook and merge tasks outside the request cycle
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .status_cache import refresh_status
+
+logging.basicConfig(level=logging.DEBUG)
+
+_queues = {}
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+class JobQueue:
+    """
+    Uses the rows of a QueuedJob model (Task, MergeTask) as the job records.
+    A job is 'queued' until a worker leases it, 'processing' while the lease
+    is held and renewed, and the handler moves it to 'completed'. Leases that
+    expire (the worker died or the server restarted) are put back in the queue.
+    The optional cleanup function removes what finished jobs left behind.
+    """
+
+    def __init__(self, name, model, handler_path, cleanup_path=None):
+        self.name = name
+        self.model = model
+        self.handler_path = handler_path
+        self.cleanup_path = cleanup_path
+
+    @property
+    def handler(self):
+        return import_string(self.handler_path)
+
+    def cleanup(self):
+        if self.cleanup_path:
+            import_string(self.cleanup_path)()
+
+    def enqueue(self, task_id, **fields):
+        # Only the first call queues the task, so reloading the processing page is harmless
+        updated = self.model.objects.filter(task_id=task_id, enqueued_at__isnull=True).update(
+            status='queued', enqueued_at=timezone.now(), **fields)
+        if updated:
+            refresh_status(self.model, task_id)
+            logging.info(f'{self.name} job {task_id} queued')
+        return bool(updated)
+
+    def requeue(self, task_id):
+        """
+        Puts a failed task back in the queue with a fresh set of attempts.
+        Running tasks are left alone, requeue_expired takes care of those
+        whose worker died.
+        """
+        updated = self.model.objects.filter(task_id=task_id, status='failed').update(
+            status='queued', enqueued_at=timezone.now(), attempts=0, leased_by='', lease_expires_at=None)
+        if updated:
+            refresh_status(self.model, task_id)
+            logging.info(f'{self.name} job {task_id} requeued')
+        return bool(updated)
+
+    def requeue_expired(self):
+        expired = self.model.objects.filter(status='processing', lease_expires_at__lt=timezone.now())
+        task_ids = list(expired.values_list('task_id', flat=True))
+        if not task_ids:
+            return
+        failed = expired.filter(attempts__gte=settings.JOB_QUEUE_MAX_ATTEMPTS).update(
+            status='failed', leased_by='', lease_expires_at=None)
+        requeued = expired.update(status='queued', leased_by='', lease_expires_at=None)
+        for task_id in task_ids:
+            refresh_status(self.model, task_id)
+        logging.info(f'{self.name} queue: {requeued} expired jobs requeued, {failed} failed')
+
+    def lease(self, worker_id):
+        job_id = (self.model.objects.filter(status='queued')
+                  .order_by('enqueued_at', 'id').values_list('id', flat=True).first())
+        if job_id is None:
+            return None
+
+        # The conditional update is the lock: only one worker can move the row out of 'queued'
+        won = self.model.objects.filter(id=job_id, status='queued').update(
+            status='processing', leased_by=worker_id, attempts=F('attempts') + 1,
+            lease_expires_at=timezone.now() + timedelta(seconds=settings.JOB_QUEUE_LEASE_SECONDS))
+        if not won:
+            return None
+        job = self.model.objects.get(id=job_id)
+        refresh_status(self.model, job.task_id)
+        return job
+
+    def renew(self, job, worker_id):
+        self.model.objects.filter(id=job.id, leased_by=worker_id).update(
+            lease_expires_at=timezone.now() + timedelta(seconds=settings.JOB_QUEUE_LEASE_SECONDS))
+
+    def run(self, job, worker_id):
+        logging.info(f'{worker_id} running {self.name} job {job.task_id} (attempt {job.attempts})')
+        try:
+            self.handler(job)
+        except Exception as e:
+            logging.error(f'{self.name} job {job.task_id} failed: {e}', exc_info=True)
+            self.model.objects.filter(id=job.id).update(status='failed')
+            refresh_status(self.model, job.task_id)
+        finally:
+            self.model.objects.filter(id=job.id, leased_by=worker_id).update(
+                leased_by='', lease_expires_at=None)
+
+
+class WorkerPool:
+    """A fixed number of worker threads that lease jobs from the registered queues."""
+
+    def __init__(self, queues, size, poll_interval):
+        self.queues = queues
+        self.size = size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+        self._running = {}
+        self._running_lock = threading.Lock()
+
+    def start(self):
+        prefix = f'{socket.gethostname()}-{os.getpid()}'
+        for i in range(self.size):
+            worker_id = f'{prefix}-worker-{i}'
+            thread = threading.Thread(target=self._work, args=(worker_id,), name=worker_id, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat, name=f'{prefix}-heartbeat', daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        cleanup = threading.Thread(target=self._cleanup, name=f'{prefix}-cleanup', daemon=True)
+        cleanup.start()
+        self._threads.append(cleanup)
+        logging.info(f'Started {self.size} job queue workers')
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _next_job(self, worker_id):
+        for queue in self.queues:
+            queue.requeue_expired()
+            job = queue.lease(worker_id)
+            if job is not None:
+                return queue, job
+        return None, None
+
+    def _work(self, worker_id):
+        while not self._stop.is_set():
+            try:
+                queue, job = self._next_job(worker_id)
+                if job is None:
+                    self._stop.wait(self.poll_interval)
+                    continue
+
+                with self._running_lock:
+                    self._running[worker_id] = (queue, job)
+                try:
+                    queue.run(job, worker_id)
+                finally:
+                    with self._running_lock:
+                        self._running.pop(worker_id, None)
+            except Exception as e:
+                logging.error(f'{worker_id} crashed while polling the job queue: {e}', exc_info=True)
+                self._stop.wait(self.poll_interval)
+            finally:
+                close_old_connections()
+
+    def _heartbeat(self):
+        # Renew the leases of running jobs well before they expire
+        interval = max(settings.JOB_QUEUE_LEASE_SECONDS / 3, 1)
+        while not self._stop.wait(interval):
+            with self._running_lock:
+                running = list(self._running.items())
+            try:
+                for worker_id, (queue, job) in running:
+                    queue.renew(job, worker_id)
+            except Exception as e:
+                logging.error(f'Failed to renew job leases: {e}')
+            finally:
+                close_old_connections()
+
+    def _cleanup(self):
+        while not self._stop.is_set():
+            for queue in self.queues:
+                try:
+                    queue.cleanup()
+                except Exception as e:
+                    logging.error(f'Cleanup of the {queue.name} queue failed: {e}')
+                finally:
+                    close_old_connections()
+            self._stop.wait(settings.JOB_QUEUE_CLEANUP_INTERVAL)
+
+
+def register_queue(name, model, handler_path, cleanup_path=None):
+    _queues[name] = JobQueue(name, model, handler_path, cleanup_path)
+    return _queues[name]
+
+def get_queue(name):
+    return _queues[name]
+
+def create_worker_pool(size=None):
+    return WorkerPool(list(_queues.values()),
+                      size or settings.JOB_QUEUE_WORKERS,
+                      settings.JOB_QUEUE_POLL_INTERVAL)
+
+def ensure_worker_pool():
+    """Start the in-process worker pool once, only when JOB_QUEUE_IN_PROCESS_WORKERS opts in."""
+    global _worker_pool
+    if not settings.JOB_QUEUE_IN_PROCESS_WORKERS or _worker_pool is not None:
+        return
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = create_worker_pool()
+            _worker_pool.start()
@@ -0,0 +1,64 @@
+# Per hook records of a task, replacing the pandas DataFrame the pipeline used to mutate
+import logging
+import queue
+from dataclasses import dataclass, field
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+@dataclass(slots=True)
+class HookRecord:
+    idx: int
+    hook_text: str
+    voice: str = ''
+    audio_filename: str = ''
+    # [start, stop) indexes into the task's source videos
+    source_slice: tuple = ()
+    input_video_filenames: list = field(default_factory=list)
+    output_path: str = ''
+    status: str = 'pending'
+    error: str = ''
+
+    @property
+    def hook_number(self):
+        return self.idx + 1
+
+    @property
+    def hook_video_filename(self):
+        return f'hook_{self.idx}.mp4'
+
+
+def build_manifest(sheet_values):
+    """
+    One record per sheet row. The sheet must have a single column of hook
+    texts, raises ValueError otherwise.
+    """
+    if not sheet_values or max(len(row) for row in sheet_values) != 1:
+        raise ValueError("The sheet must have exactly one column of hook texts")
+    return [HookRecord(idx=idx, hook_text=row[0] if row else '') for idx, row in enumerate(sheet_values)]
+
+
+class ResultCollector:
+    """
+    TTS threads and render callbacks report field updates here instead of
+    writing shared state; the thread that owns the manifest applies them.
+    """
+
+    def __init__(self):
+        self._updates = queue.SimpleQueue()
+
+    def report(self, idx, **fields):
+        self._updates.put((idx, fields))
+
+    def apply(self, manifest):
+        """Applies every pending update to the records, returns how many were applied."""
+        applied = 0
+        while True:
+            try:
+                idx, fields = self._updates.get_nowait()
+            except queue.Empty:
+                return applied
+            record = manifest[idx]
+            for name, value in fields.items():
+                setattr(record, name, value)
+            applied += 1
@@ -0,0 +1,137 @@
+# Persistent index of video stream metadata, so a file is probed once across tasks and processes
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+from hooks.models import MediaProbe
+
+logging.basicConfig(level=logging.DEBUG)
+
+# Bytes hashed from the start and the end of a file to identify its content
+CONTENT_SAMPLE_BYTES = 1024 * 1024
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def content_key(path):
+    """
+    Identifies a file by its size and a hash of its first and last megabyte,
+    so renamed or re-uploaded copies share one index entry. The key is
+    remembered per path, size and mtime to skip hashing unchanged files.
+    """
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _keys_lock:
+        key = _keys.get(stamp)
+    if key is not None:
+        return key
+
+    digest = hashlib.sha256(str(stat.st_size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(CONTENT_SAMPLE_BYTES))
+        if stat.st_size > CONTENT_SAMPLE_BYTES:
+            f.seek(max(CONTENT_SAMPLE_BYTES, stat.st_size - CONTENT_SAMPLE_BYTES))
+            digest.update(f.read(CONTENT_SAMPLE_BYTES))
+    key = digest.hexdigest()
+    with _keys_lock:
+        _keys[stamp] = key
+    return key
+
+def parse_frame_rate(frame_rate):
+    try:
+        num, _, den = frame_rate.partition('/')
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+def count_keyframes(path):
+    # Reads packet flags only, nothing is decoded
+    command = [settings.FFPROBE_BINARY, '-v', 'error', '-select_streams', 'v:0',
+               '-show_entries', 'packet=flags', '-of', 'csv=p=0', path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return None
+    return sum(1 for line in result.stdout.decode().splitlines() if 'K' in line)
+
+def run_ffprobe(path):
+    """Returns the MediaProbe fields of a file, read with ffprobe."""
+    command = [settings.FFPROBE_BINARY, '-v', 'error', '-show_entries',
+               'stream=codec_type,codec_name,profile,pix_fmt,width,height,r_frame_rate,'
+               'sample_rate,channels,channel_layout:format=duration', '-of', 'json', path]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffprobe failed on {path}: {result.stderr.decode()}")
+
+    data = json.loads(result.stdout.decode() or '{}')
+    streams = data.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise Exception(f"Could not find a video stream in {path}")
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+
+    duration = data.get('format', {}).get('duration')
+    return {
+        'video_codec': video.get('codec_name', ''),
+        'video_profile': video.get('profile', ''),
+        'pix_fmt': video.get('pix_fmt', ''),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'frame_rate': video.get('r_frame_rate', ''),
+        'fps': parse_frame_rate(video.get('r_frame_rate', '')),
+        'duration': float(duration) if duration else None,
+        'keyframes': count_keyframes(path),
+        'audio_codec': audio.get('codec_name', ''),
+        'audio_channels': audio.get('channels'),
+        'audio_layout': audio.get('channel_layout', ''),
+        'audio_sample_rate': int(audio['sample_rate']) if audio.get('sample_rate') else None,
+    }
+
+def run_ffmpeg_parse_infos(path):
+    """
+    Fallback where ffprobe is not installed: moviepy's bundled ffmpeg only
+    reports size, frame rate, duration and whether there is audio.
+    """
+    infos = ffmpeg_parse_infos(path)
+    width, height = infos['video_size']
+    return {
+        'width': width,
+        'height': height,
+        'frame_rate': str(infos['video_fps']) if infos.get('video_fps') else '',
+        'fps': infos.get('video_fps'),
+        'duration': infos.get('duration'),
+        'audio_sample_rate': infos.get('audio_fps') if infos.get('audio_found') else None,
+    }
+
+def probe_media(path):
+    """
+    Returns the MediaProbe of a file, probing it only when its content was
+    never seen before.
+    """
+    key = content_key(path)
+    media_probe = MediaProbe.objects.filter(content_key=key).first()
+    if media_probe is not None:
+        return media_probe
+
+    logging.info(f"Probing {path}")
+    try:
+        fields = run_ffprobe(path)
+    except FileNotFoundError:
+        fields = run_ffmpeg_parse_infos(path)
+
+    stat = os.stat(path)
+    try:
+        media_probe, _ = MediaProbe.objects.update_or_create(
+            content_key=key,
+            defaults={'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, **fields})
+    except IntegrityError:
+        # Another worker indexed the same file first
+        media_probe = MediaProbe.objects.get(content_key=key)
+    return media_probe
@@ -0,0 +1,122 @@
+# Cache for rendered hook text overlays, kept in memory and on disk
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+from django.conf import settings
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class OverlayEntry:
+    """A finished overlay: the RGBA image, the PNG it is stored in and the heights of its color bands."""
+
+    def __init__(self, rgba, path, band_heights):
+        self.rgba = rgba
+        self.path = path
+        self.band_heights = band_heights
+
+
+class OverlayCache:
+    """
+    Maps an overlay key to its OverlayEntry. The most recently used entries are
+    kept in memory, every entry is also written to `cache_dir` so other worker
+    processes and later tasks can reuse it. Both levels evict the least recently
+    used entries once they hold more than their limit.
+    """
+
+    def __init__(self, cache_dir, max_memory_entries, max_disk_entries):
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=list).encode()).hexdigest()
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, f'{key}.png'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            # The PNG is handed to ffmpeg, keep it off the eviction list of other processes
+            # and write it again if one of them already removed it
+            try:
+                os.utime(entry.path)
+            except FileNotFoundError:
+                self._write(key, entry.rgba, entry.band_heights)
+            return entry
+
+        image_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                band_heights = json.load(f)
+            rgba = np.array(Image.open(image_path).convert('RGBA'))
+            os.utime(image_path)  # mark as recently used for disk eviction
+        except (OSError, ValueError):
+            return None
+
+        entry = OverlayEntry(rgba, image_path, band_heights)
+        self._remember(key, entry)
+        return entry
+
+    def _write(self, key, rgba, band_heights):
+        image_path, meta_path = self._paths(key)
+        # Write to temp files first so readers never see a half written overlay
+        Image.fromarray(rgba, 'RGBA').save(image_path + '.tmp', format='PNG')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(band_heights, f)
+        os.replace(meta_path + '.tmp', meta_path)
+        os.replace(image_path + '.tmp', image_path)
+        return image_path
+
+    def put(self, key, rgba, band_heights):
+        image_path = self._write(key, rgba, band_heights)
+        entry = OverlayEntry(rgba, image_path, band_heights)
+        self._remember(key, entry)
+        self._evict_disk()
+        return entry
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def _evict_disk(self):
+        try:
+            images = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith('.png')]
+            if len(images) <= self.max_disk_entries:
+                return
+            images.sort(key=os.path.getmtime)
+            for image_path in images[:len(images) - self.max_disk_entries]:
+                os.remove(image_path)
+                os.remove(image_path[:-len('.png')] + '.json')
+        except OSError as e:
+            logging.warning(f'Failed to evict overlay cache entries: {e}')
+
+
+_overlay_cache = None
+_overlay_cache_lock = threading.Lock()
+
+def get_overlay_cache():
+    global _overlay_cache
+    with _overlay_cache_lock:
+        if _overlay_cache is None:
+            _overlay_cache = OverlayCache(settings.HOOKS_OVERLAY_CACHE_DIR,
+                                          settings.HOOKS_OVERLAY_CACHE_MEMORY_ENTRIES,
+                                          settings.HOOKS_OVERLAY_CACHE_DISK_ENTRIES)
+        return _overlay_cache
@@ -2,20 +2,30 @@ import logging
 import os
 import subprocess
 import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
-import pandas as pd
 from moviepy.editor import AudioFileClip
 
+from django.conf import settings
 from django.core.cache import cache
 from django.http import JsonResponse
 
 from hooks.models import Hook
 
-from .utils import hex_to_rgb, handle_task_cancellation, delete_temp_dir
-from .spreadsheet_extractor import fetch_google_sheet_data, extract_word_color_data
-from .audio_processors import process_audios
-from .video_processors import process_audio_on_videos
+from .utils import hex_to_rgb, handle_task_cancellation
+from .spreadsheet_extractor import fetch_google_sheet, take_prewarmed_sheet, build_word_color_index
+from .audio_processors import process_audios, get_tts_client
+from .video_processors import render_hook
+from .render_pool import get_render_executor, render_workers
+from .scheduler import RenderScheduler
+from .source_pool import close_source_pool
+from .ingest import normalize_sources
+from .progress import TaskProgress
+from .manifest import build_manifest, ResultCollector
+from .checkpoints import TaskCheckpoints
 
 from hooks.models import Task
 
@@ -25,21 +35,18 @@ canceled_tasks = set()
 def process(params):
     task_id = params.get('task_id', None)
     try:
-        input_df = params['input_df']
-        if 'Hook Text' not in input_df.columns:
-            raise Exception("The column 'Hook Text' does not exist in the DataFrame.")
+        manifest = params['manifest']
+        if not manifest:
+            raise Exception("The task manifest has no hooks.")
         
         google_sheet_link = params.get('google_sheet_link')
         if not google_sheet_link:
             raise Exception("Missing 'google_sheet_link' in params.")
         
-        word_color_data = extract_word_color_data(google_sheet_link)
-
-        for idx, row in input_df.iterrows():
-            hook_text = row['Hook Text']
+        # Fetched together with the values in process_files
+        word_color_data = params.get('word_color_data')
 
         ELEVENLABS_API_KEY = params['api_key']
-        no_of_parallel_executions = params['parallel_processing']
 
         INPUT_DIR = params['input_dir']
         OUTPUT_DIR = params['output_dir']
@@ -47,6 +54,7 @@ def process(params):
         temp_dir = params['temp_dir']
         top_box_color = params['top_box_color']
         default_text_color = params['default_text_color']
+        progress = params.get('progress') or TaskProgress(task_id)
 
         input_videos_folder = os.path.join(INPUT_DIR, 'video')
         output_audios_folder = os.path.join(OUTPUT_DIR, 'audios')
@@ -59,80 +67,197 @@ def process(params):
         if len(os.listdir(input_videos_folder)) == 0:
             raise Exception(f"input/videos folder {input_videos_folder} does not contain any videos")
         video_files = sorted([f for f in os.listdir(input_videos_folder) if f.endswith('.mp4') or f.endswith('.mov')])
-
-        for col in ["Hook Video Filename", "Input Video Filename", "Audio Filename", "Voice"]:
-            if col not in input_df.columns:
-                input_df[col] = ''
-
-        l_unprocessed_rows = len(input_df[input_df['Hook Video Filename'] == ''])
-
-        all_hooks = []
-        total_rows = len(input_df)
-        current_row = 0
-
-        for idx_1, row in tqdm(input_df.iterrows(), total=total_rows, desc="Processing rows"):
-            hook_text = row['Hook Text']
-            hook_number = idx_1 + 1
-
-            process_audios(ELEVENLABS_API_KEY, row, hook_number, hook_text, input_df, idx_1, output_audios_folder, voice_id)
-            logging.info('Audio proccessed successfully')
-
-        current_thread_count = 0
-
-        for idx, row in tqdm(input_df.iterrows(), total=total_rows, desc="Processing rows"):
-            hook_text = row['Hook Text']
-            hook_number = idx + 1
-
-            audio_clip = AudioFileClip(os.path.join(output_audios_folder, row['Audio Filename']))
-            video_index = idx % len(video_files)
-            num_videos_to_use = int(round(audio_clip.duration / 2))
-
-            video_file_size = len(video_files)
-            if num_videos_to_use + video_index > video_file_size:
-                num_videos_to_use = video_file_size - video_index
-
-            last_video = video_index + num_videos_to_use
-            video_files_to_use = [os.path.join(input_videos_folder, video_files[i]) for i in range(video_index, last_video)]
-
-            if params['task_id'] in canceled_tasks:
-                return handle_task_cancellation(temp_dir, task_id)
-
-            hook_job = threading.Thread(target=process_audio_on_videos, args=(row, video_files_to_use, idx, input_df, hook_number, hook_text, num_videos_to_use, audio_clip, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, output_videos_folder, total_rows, task_id, top_box_color, default_text_color, word_color_data))
-            hook_job.start()
-            all_hooks.append(hook_job)
-            current_thread_count += 1
-            if current_thread_count == int(no_of_parallel_executions):
-                for hook in all_hooks:
-                    hook.join()
-                all_hooks.clear()
-                current_thread_count = 0
-        for hook in all_hooks:
-            try:
-                hook.join()
-            except Exception as err:
-                logging.error(f'failed to join all hooks --> {str(err)}')
-
-        # Now generate the video links after all processing is complete
-        credits_used = 0
+        source_paths = [os.path.join(input_videos_folder, f) for f in video_files]
+
+        # Crop and scale every source once instead of once per hook. This runs next to the
+        # TTS stage, a hook only waits for it once its voiceover is done
+        normalize_limit = settings.HOOKS_NORMALIZE_MAX_SECONDS
+        ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{task_id}-ingest')
+        if settings.HOOKS_NORMALIZE_SOURCES:
+            normalized_sources = ingest_executor.submit(normalize_sources, source_paths,
+                                                        os.path.join(INPUT_DIR, 'normalized'),
+                                                        OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, normalize_limit)
+        else:
+            normalized_sources = ingest_executor.submit(list, source_paths)
+
+        # Everything started below is torn down in the finally, even when rendering raises
+        tts_stage = None
+        finished = False
+        stop_producing = threading.Event()
+        try:
+            total_rows = len(manifest)
+            progress.set_total(total_rows)
+
+            # Hooks finished by an earlier attempt of this task are not redone
+            checkpoints = TaskCheckpoints(task_id)
+            checkpoints.restore(manifest, output_audios_folder)
+            pending = [record for record in manifest if record.status != 'rendered']
+            for record in manifest:
+                if record.status == 'rendered':
+                    progress.hook_update(record.hook_number, 'rendered', restored=True)
+            progress.set_stage('tts')
+
+            def build_render_job(record, audio_filename):
+                idx = record.idx
+                hook_text = record.hook_text
+                hook_number = record.hook_number
+
+                audio_path = os.path.join(output_audios_folder, audio_filename)
+                audio_clip = AudioFileClip(audio_path)
+                audio_duration = audio_clip.duration
+                audio_clip.close()
+                video_index = idx % len(video_files)
+                num_videos_to_use = int(round(audio_duration / 2))
+
+                video_file_size = len(video_files)
+                if num_videos_to_use + video_index > video_file_size:
+                    num_videos_to_use = video_file_size - video_index
+
+                last_video = video_index + num_videos_to_use
+                # Normalized sources are cut after HOOKS_NORMALIZE_MAX_SECONDS, a hook that reads
+                # longer slices than that renders from the uploads
+                slice_seconds = audio_duration / max(num_videos_to_use, 1)
+                hook_sources = normalized_sources.result()
+                if normalize_limit and slice_seconds > normalize_limit:
+                    hook_sources = source_paths
+                video_files_to_use = [hook_sources[i] for i in range(video_index, last_video)]
+
+                # Only this row's colors are sent to the renderer, aligned to the words it draws
+                # (renderers drop underscores from the hook text)
+                row_word_data = word_color_data[idx] if word_color_data and idx < len(word_color_data) else []
+                word_color_index = build_word_color_index(row_word_data, hook_text.replace('_', ''))
+
+                collector.report(idx, source_slice=(video_index, last_video))
+                return {
+                    'idx': idx,
+                    'hook_number': hook_number,
+                    'hook_text': hook_text,
+                    'audio_path': audio_path,
+                    'video_files': video_files_to_use,
+                    'num_videos_to_use': num_videos_to_use,
+                    'width': OUT_VIDEO_WIDTH,
+                    'height': OUT_VIDEO_HEIGHT,
+                    'output_videos_folder': output_videos_folder,
+                    'total_rows': total_rows,
+                    'task_id': task_id,
+                    'top_box_color': top_box_color,
+                    'default_text_color': default_text_color,
+                    'word_color_index': word_color_index,
+                    'render_backend': params['render_backend'],
+                }
+
+            # The TTS stage feeds the render stage through a bounded queue, so each
+            # hook starts rendering as soon as its voiceover exists
+            render_queue = queue.Queue(maxsize=settings.HOOKS_PIPELINE_QUEUE_SIZE)
+            # Stage threads never write the manifest, they report to the collector
+            # and this thread applies the updates once the pipeline is done
+            collector = ResultCollector()
+
+            def prepare_hook(record):
+                started_at = time.monotonic()
+                progress.hook_update(record.hook_number, 'voicing')
+                voice, audio_filename = process_audios(ELEVENLABS_API_KEY, record.audio_filename, record.hook_number,
+                                                       record.hook_text, output_audios_folder, voice_id)
+                collector.report(record.idx, voice=voice, audio_filename=audio_filename, status='voiced')
+                if audio_filename:
+                    checkpoints.audio_done(record, voice, audio_filename)
+                logging.info('Audio proccessed successfully')
+                job = build_render_job(record, audio_filename)
+                progress.hook_update(record.hook_number, 'voiced', tts_seconds=round(time.monotonic() - started_at, 2))
+                return job
+
+            def produce_audios():
+                # Several rows are synthesized at once over the client's pooled connections
+                tts_executor = ThreadPoolExecutor(max_workers=get_tts_client(ELEVENLABS_API_KEY).concurrency,
+                                                  thread_name_prefix=f'{task_id}-tts')
+                try:
+                    futures = {}
+                    for record in pending:
+                        futures[tts_executor.submit(prepare_hook, record)] = record.idx
+                    for future in tqdm(as_completed(futures), total=len(pending), desc="Processing rows"):
+                        if task_id in canceled_tasks or stop_producing.is_set():
+                            break
+                        try:
+                            render_queue.put(future.result())
+                        except Exception as err:
+                            logging.error(f"failed to prepare hook {futures[future] + 1} --> {str(err)}", exc_info=True)
+                            progress.hook_update(futures[future] + 1, 'failed', error=str(err))
+                            collector.report(futures[future], status='failed', error=str(err))
+                    else:
+                        # Every voiceover exists, only renders are left
+                        progress.set_stage('render')
+                finally:
+                    tts_executor.shutdown(wait=False, cancel_futures=True)
+                    render_queue.put(None)
+
+            tts_stage = threading.Thread(target=produce_audios, name=f'{task_id}-tts', daemon=True)
+            tts_stage.start()
+
+            def on_render_submit(job):
+                progress.hook_update(job['hook_number'], 'rendering')
+
+            def on_render_result(job, result):
+                collector.report(result['idx'], input_video_filenames=result['Input Video Filename'],
+                                 output_path=result['output_path'] or '', status='rendered')
+                if result['output_path']:
+                    checkpoints.video_done(manifest[result['idx']], result['output_path'])
+                progress.hook_update(job['hook_number'], 'rendered', render_seconds=result['render_seconds'])
+
+            def on_render_error(job, err):
+                logging.error(f"failed to render hook {job['hook_number']} --> {str(err)}", exc_info=err)
+                progress.hook_update(job['hook_number'], 'failed', error=str(err))
+                collector.report(job['idx'], status='failed', error=str(err))
+
+            scheduler = RenderScheduler(get_render_executor(), render_workers(), executor_factory=get_render_executor)
+            finished = scheduler.run_queue(render_queue, render_hook, on_render_result, on_render_error,
+                                           should_cancel=lambda: task_id in canceled_tasks,
+                                           on_submit=on_render_submit)
+            logging.info(f"Render scheduler finished: {scheduler.stats()}")
+        finally:
+            if tts_stage is not None:
+                if not finished:
+                    # Stop the TTS stage and unblock it until it sends its sentinel
+                    stop_producing.set()
+                    while render_queue.get() is not None:
+                        pass
+                tts_stage.join()
+            ingest_executor.shutdown(wait=True, cancel_futures=True)
+            close_source_pool(task_id)
+        collector.apply(manifest)
+        if not finished:
+            return handle_task_cancellation(temp_dir, task_id)
+
+        # Now generate the video links after all processing is complete, only for rendered hooks
+        progress.set_stage('finalize')
         video_links = []
-        for idx, row in input_df.iterrows():
+        to_charge = []
+        failed_hooks = []
+        for record in manifest:
+            if record.status != 'rendered':
+                failed_hooks.append(record.hook_number)
+                continue
             logging.info('Trying to generate link')
-            row['Hook Video Filename'] = f'hook_{idx}.mp4'
-            video_path = os.path.join(output_videos_folder, row['Hook Video Filename'])
+            video_path = os.path.join(output_videos_folder, record.hook_video_filename)
             video_links.append({
-                    'file_name': row['Hook Video Filename'],
+                    'file_name': record.hook_video_filename,
                     'video_link': video_path
                 })
-            credits_used += 1
-            logging.info("used one credit")
-            logging.info(f"Generated video link with file name: {row['Hook Video Filename']}")
-
-        logging.info(f"Task {task_id} completed.")
-        return video_links, credits_used
+            # Hooks charged by an earlier attempt of this task are not charged again
+            if not checkpoints.is_charged(record):
+                to_charge.append(record)
+            logging.info(f"Generated video link with file name: {record.hook_video_filename}")
+
+        progress.set_stage('done')
+        if failed_hooks:
+            logging.error(f"Task {task_id}: hooks {failed_hooks} failed, the task can be resumed")
+        else:
+            logging.info(f"Task {task_id} completed.")
+        return video_links, to_charge, failed_hooks
 
     except Exception as e:
+        # The working directory is kept, a resumed task picks up its checkpointed files
         logging.error(f"Error during processing ---> {str(e)}")
-        delete_temp_dir(params.get('temp_dir', ''))
+        raise
 
 def process_files(temp_dir, task_id):
 
@@ -146,6 +271,7 @@ def process_files(temp_dir, task_id):
     voice_id = hook_object.voice_id
     api_key = hook_object.eleven_labs_api_key
     parallel_processing = hook_object.parallel_processing
+    render_backend = hook_object.render_backend
     top_box_color_value = hook_object.box_color
     main_box_color_value = hook_object.font_color
 
@@ -171,20 +297,22 @@ def process_files(temp_dir, task_id):
     video_file_name = os.path.basename(video_files.name)
     video_file_path = os.path.join(input_videos_folder, video_file_name)
     os.makedirs(os.path.dirname(video_file_path), exist_ok=True)
-    with open(video_file_path, 'wb+') as destination:
-        for chunk in video_files.chunks():
-            destination.write(chunk)
+    # A resumed task already has the upload in its working directory
+    if not os.path.exists(video_file_path) or os.path.getsize(video_file_path) != video_files.size:
+        with open(video_file_path, 'wb+') as destination:
+            for chunk in video_files.chunks():
+                destination.write(chunk)
     video_files_paths.append(video_file_path)
 
     # Fetch the data from Google Sheets
-    google_sheet_data = fetch_google_sheet_data(google_sheet_link)
-    extract_word_color_data(google_sheet_link)
-    input_df = pd.DataFrame(google_sheet_data)
-    if input_df.empty or ('Hook Text' not in input_df.columns and input_df.shape[1] > 0):
-        if input_df.shape[1] == 1:
-            input_df.columns = ['Hook Text']
-        else:
-            return JsonResponse({"error": "Ensure the google sheet access is updated to anyone with link."})
+    progress = TaskProgress(task_id)
+    progress.set_stage('sheet')
+    # Values and word colors come from one request, usually already made when the link was validated
+    google_sheet = take_prewarmed_sheet(google_sheet_link) or fetch_google_sheet(google_sheet_link)
+    try:
+        manifest = build_manifest(google_sheet['values'])
+    except ValueError:
+        return JsonResponse({"error": "Ensure the google sheet access is updated to anyone with link."})
         
     # Create a params dictionary to pass to the background task
     params = {
@@ -198,10 +326,12 @@ def process_files(temp_dir, task_id):
         "temp_dir": temp_dir,
         "top_box_color": top_box_color,
         "default_text_color": default_text_color,
-        "input_df": input_df,
-        "google_sheet_link": google_sheet_link
+        "manifest": manifest,
+        "google_sheet_link": google_sheet_link,
+        "word_color_data": google_sheet['word_color_data'],
+        "render_backend": render_backend,
+        "progress": progress
     }  
     cache.set(task_id, temp_dir, timeout=600)
 
-    video_links, credits_used = process(params)
-    return video_links, credits_used
\ No newline at end of file
+    return process(params)
\ No newline at end of file
@@ -0,0 +1,94 @@
+# Per task progress of the hook pipeline, written to the Task row in batches
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from hooks.models import Task
+
+from .status_cache import refresh_status
+
+logging.basicConfig(level=logging.DEBUG)
+
+# Pipeline stages in order, TTS and render overlap: 'render' starts once every voiceover is done.
+# Source normalization runs during 'tts'
+STAGES = ('sheet', 'tts', 'render', 'finalize', 'done')
+# Hook states in order
+HOOK_STATES = ('pending', 'voicing', 'voiced', 'rendering', 'rendered')
+
+
+class TaskProgress:
+    """
+    Tracks the stage of a task, the state and timings of every hook and the
+    seconds spent per stage. Updates are kept in memory and written to the
+    Task row at most every HOOKS_PROGRESS_FLUSH_SECONDS, so hundreds of hook
+    updates cost a handful of UPDATE statements. Stage changes are written
+    immediately.
+    """
+
+    def __init__(self, task_id, flush_interval=None):
+        self.task_id = task_id
+        self.flush_interval = settings.HOOKS_PROGRESS_FLUSH_SECONDS if flush_interval is None else flush_interval
+        self.stage = ''
+        self.stage_seconds = {}
+        self.hooks = {}
+        self._stage_started_at = None
+        self._last_flush = 0.0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def set_stage(self, stage):
+        now = time.monotonic()
+        with self._lock:
+            if self.stage and self._stage_started_at is not None:
+                self.stage_seconds[self.stage] = round(now - self._stage_started_at, 2)
+            self.stage = stage
+            self._stage_started_at = now
+            self._dirty = True
+        logging.info(f"Task {self.task_id} stage: {stage}")
+        self.flush(force=True)
+
+    def set_total(self, total):
+        with self._lock:
+            self.hooks = {str(hook_number): {'state': 'pending'} for hook_number in range(1, total + 1)}
+            self._dirty = True
+        self.flush()
+
+    def hook_update(self, hook_number, state, **fields):
+        """Moves a hook to `state`, extra fields such as timings are stored with it."""
+        with self._lock:
+            hook = self.hooks.setdefault(str(hook_number), {})
+            hook['state'] = state
+            hook.update(fields)
+            self._dirty = True
+        self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            states = [hook['state'] for hook in self.hooks.values()]
+            return {
+                'total': len(states),
+                'voiced': sum(1 for state in states if state in HOOK_STATES[2:]),
+                'rendered': states.count('rendered'),
+                'failed': states.count('failed'),
+                'stage_seconds': dict(self.stage_seconds),
+                'hooks': {number: dict(hook) for number, hook in self.hooks.items()},
+            }
+
+    def flush(self, force=False):
+        with self._lock:
+            if not self._dirty or (not force and time.monotonic() - self._last_flush < self.flush_interval):
+                return
+            self._dirty = False
+            self._last_flush = time.monotonic()
+        # Writes are serialized so an older snapshot never overwrites a newer one
+        with self._write_lock:
+            try:
+                Task.objects.filter(task_id=self.task_id).update(
+                    stage=self.stage, progress=self.snapshot(), progress_updated_at=timezone.now())
+                refresh_status(Task, self.task_id)
+            except Exception as e:
+                logging.warning(f"Failed to save progress of task {self.task_id}: {e}")
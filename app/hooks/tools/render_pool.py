@@ -0,0 +1,61 @@
+# Shared executors used to render hook videos
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from django.conf import settings
+
+from .cpu_budget import get_budget
+
+logging.basicConfig(level=logging.DEBUG)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def render_workers():
+    """Number of hooks rendered at the same time, defaults to one per core."""
+    return settings.HOOKS_RENDER_WORKERS or os.cpu_count() or 1
+
+def _init_render_worker(budget):
+    # Worker processes are spawned, so Django has to be set up again before rendering
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hooks_app.settings')
+    django.setup()
+
+    # Worker processes reserve encoder threads from the parent's budget
+    from .cpu_budget import configure_budget
+    configure_budget(budget)
+
+    # Fonts are registered once per worker process and shared by every render
+    from .font_utils import get_font_registry
+    get_font_registry()
+
+def get_render_executor():
+    """
+    Returns the process-wide render executor. moviepy compositing holds the GIL,
+    so HOOKS_RENDER_EXECUTOR = 'process' renders every hook in its own worker
+    process, while 'thread' keeps the old in-process behaviour.
+    """
+    global _executor
+    with _executor_lock:
+        # A worker process that died takes the whole pool down with it, start a fresh one
+        if _executor is not None and getattr(_executor, '_broken', False):
+            logging.error('Render executor is broken, creating a new one')
+            _executor.shutdown(wait=False)
+            _executor = None
+            # Renders killed with the pool never returned their encoder threads
+            get_budget().reclaim()
+        if _executor is None:
+            workers = render_workers()
+            if settings.HOOKS_RENDER_EXECUTOR == 'process':
+                _executor = ProcessPoolExecutor(max_workers=workers,
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_render_worker,
+                                                initargs=(get_budget(),))
+            else:
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hook-render')
+            logging.info(f'Created {settings.HOOKS_RENDER_EXECUTOR} render executor with {workers} workers')
+        return _executor
@@ -0,0 +1,130 @@
+# Keeps a fixed number of hook renders in flight on an executor
+import logging
+import queue
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .cpu_budget import get_budget
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class RenderScheduler:
+    """
+    Sliding window scheduler: up to `slots` jobs run at the same time and the
+    next job is submitted as soon as any running one finishes, so a slow hook
+    only occupies its own slot instead of holding back a whole batch.
+    When a worker process dies the pool breaks: the jobs it was running fail
+    through on_error and the rest continue on a pool from `executor_factory`.
+    """
+
+    def __init__(self, executor, slots, poll_interval=0.5, executor_factory=None):
+        self.executor = executor
+        self.executor_factory = executor_factory
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.queue_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self._slot_busy = [0.0] * slots
+        self._started_at = None
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self._started_at, 1e-6) if self._started_at else 0
+        return {
+            'queue_depth': self.queue_depth,
+            'completed': self.completed,
+            'failed': self.failed,
+            'slot_utilization': [round(busy / elapsed, 3) if elapsed else 0.0 for busy in self._slot_busy],
+        }
+
+    def _replace_executor(self, err):
+        if self.executor_factory is None:
+            raise err
+        logging.error(f'Render executor broke, continuing on a new one --> {err}')
+        self.executor = self.executor_factory()
+
+    def _submit(self, fn, job):
+        try:
+            return self.executor.submit(fn, job)
+        except BrokenProcessPool as err:
+            # Broken before this job ran, it gets one try on the new pool
+            self._replace_executor(err)
+            return self.executor.submit(fn, job)
+
+    def run(self, jobs, fn, on_result, on_error, should_cancel=None, on_submit=None):
+        """Runs fn(job) for every job in a known list, see run_queue."""
+        job_queue = queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        job_queue.put(None)
+        return self.run_queue(job_queue, fn, on_result, on_error, should_cancel, on_submit)
+
+    def run_queue(self, job_queue, fn, on_result, on_error, should_cancel=None, on_submit=None):
+        """
+        Runs fn(job) for every job put on job_queue until a None sentinel is read,
+        so jobs can be scheduled while they are still being produced.
+        on_result(job, result) and on_error(job, err) are called in this thread
+        as jobs finish, on_submit(job) when a job gets a slot. Returns False if should_cancel() stopped the run early.
+        """
+        self._started_at = time.monotonic()
+        free_slots = list(range(self.slots))
+        running = {}
+        exhausted = False
+
+        while not exhausted or running:
+            if should_cancel is not None and should_cancel():
+                for future in running:
+                    future.cancel()
+                get_budget().add_demand(-len(running))
+                return False
+
+            # Fill every free slot before waiting, only block on the queue when nothing is running
+            while free_slots and not exhausted:
+                try:
+                    job = job_queue.get(block=not running, timeout=self.poll_interval)
+                except queue.Empty:
+                    break
+                if job is None:
+                    exhausted = True
+                    break
+                slot = free_slots.pop()
+                if on_submit is not None:
+                    on_submit(job)
+                try:
+                    future = self._submit(fn, job)
+                except BrokenProcessPool as err:
+                    free_slots.append(slot)
+                    self.failed += 1
+                    on_error(job, err)
+                    continue
+                # Counted before the render reaches its encode, so encoder threads are split between every render in flight
+                get_budget().add_demand(1)
+                running[future] = (slot, job, time.monotonic())
+            self.queue_depth = job_queue.qsize()
+
+            if not running:
+                continue
+            done, _ = wait(running, timeout=None if exhausted else self.poll_interval,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                slot, job, submitted_at = running.pop(future)
+                get_budget().add_demand(-1)
+                self._slot_busy[slot] += time.monotonic() - submitted_at
+                free_slots.append(slot)
+                try:
+                    on_result(job, future.result())
+                    self.completed += 1
+                except BrokenProcessPool as err:
+                    self.failed += 1
+                    on_error(job, err)
+                    if self.executor_factory is not None and getattr(self.executor, '_broken', False):
+                        self._replace_executor(err)
+                except Exception as err:
+                    self.failed += 1
+                    on_error(job, err)
+
+            if done:
+                logging.info(f'Render scheduler: {self.stats()}')
+        return True
@@ -0,0 +1,140 @@
+# Shared probe metadata and readers for the source videos of a task
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from moviepy.editor import VideoClip, VideoFileClip
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader, ffmpeg_parse_infos
+
+from .media_probe import probe_media
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class ProbedVideoReader(FFMPEG_VideoReader):
+    """
+    FFMPEG_VideoReader built from the result of an earlier ffmpeg_parse_infos
+    call instead of running ffmpeg once more to read the file's metadata.
+    """
+
+    def __init__(self, filename, infos, pix_fmt='rgb24'):
+        self.filename = filename
+        self.proc = None
+        self.fps = infos['video_fps']
+        self.size = infos['video_size']
+        self.rotation = infos['video_rotation']
+        self.resize_algo = 'bicubic'
+        self.duration = infos['video_duration']
+        self.ffmpeg_duration = infos['duration']
+        self.nframes = infos['video_nframes']
+        self.infos = infos
+        self.pix_fmt = pix_fmt
+        self.depth = 3
+        self.bufsize = self.depth * self.size[0] * self.size[1] + 100
+        self.initialize()
+        self.pos = 1
+        self.lastread = self.read_frame()
+
+
+class ProbedVideoFileClip(VideoFileClip):
+    """Video-only VideoFileClip whose reader uses already parsed infos."""
+
+    def __init__(self, filename, infos):
+        VideoClip.__init__(self)
+        self.reader = ProbedVideoReader(filename, infos)
+        self.duration = self.end = self.reader.duration
+        self.fps = self.reader.fps
+        self.size = self.reader.size
+        self.rotation = self.reader.rotation
+        self.filename = filename
+        self.make_frame = lambda t: self.reader.get_frame(t)
+
+
+class SourcePool:
+    """
+    Every hook of a task draws from the same few input videos. The pool
+    parses each source's metadata once per process and opens a reader per
+    hook from it, which release() closes as soon as the hook is written, so
+    N hooks over K sources cost K probes instead of N x K. Readers are not
+    kept for the next hook: every hook reads from t=0, and moviepy restarts
+    the ffmpeg process of a reader on any backwards seek, so an idle reader
+    would only hold a process open.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._infos = {}
+        self._reader_infos = {}
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def probe(self, path):
+        """Probe index metadata in moviepy's infos format, for the ffmpeg backend."""
+        with self._lock:
+            infos = self._infos.get(path)
+        if infos is None:
+            infos = probe_media(path).as_infos()
+            with self._lock:
+                self._infos[path] = infos
+        return infos
+
+    def reader_infos(self, path):
+        """The ffmpeg_parse_infos result moviepy's reader needs, parsed once per source."""
+        with self._lock:
+            infos = self._reader_infos.get(path)
+        if infos is None:
+            infos = ffmpeg_parse_infos(path)
+            with self._lock:
+                self._reader_infos[path] = infos
+        return infos
+
+    def acquire(self, path):
+        if self.closed:
+            raise Exception(f"Source pool of task {self.task_id} is closed")
+        # The source audio is replaced by the voiceover, so only the video stream is opened
+        clip = ProbedVideoFileClip(path, self.reader_infos(path))
+        logging.info(f"Opened reader for {path}")
+        return clip
+
+    def release(self, path, clip):
+        try:
+            clip.close()
+        except Exception as e:
+            logging.warning(f"Failed to close source reader of {path}: {e}")
+
+    def close(self):
+        # Readers are closed by their hooks, only the metadata is dropped here
+        with self._lock:
+            self.closed = True
+            self._infos.clear()
+            self._reader_infos.clear()
+        logging.info(f"Closed source pool of task {self.task_id}")
+
+
+_pools = OrderedDict()
+_pools_lock = threading.Lock()
+
+def get_source_pool(task_id):
+    """
+    Returns this process' pool for the task. Render worker processes cannot be
+    told when a task ends, so only the metadata of the most recently used
+    pools is kept; no pool holds an open reader between hooks.
+    """
+    with _pools_lock:
+        pool = _pools.get(task_id)
+        if pool is None:
+            pool = _pools[task_id] = SourcePool(task_id)
+        _pools.move_to_end(task_id)
+        stale = []
+        while len(_pools) > settings.HOOKS_SOURCE_POOLS_PER_PROCESS:
+            stale.append(_pools.popitem(last=False)[1])
+    for stale_pool in stale:
+        stale_pool.close()
+    return pool
+
+def close_source_pool(task_id):
+    with _pools_lock:
+        pool = _pools.pop(task_id, None)
+    if pool is not None:
+        pool.close()
@@ -1,7 +1,12 @@
+import hashlib
 import re
+import time
+from functools import lru_cache
 import requests
 import logging
 from django.conf import settings
+from django.core.cache import caches
+from .utils import split_hook_text
 
 # setup logging
 logging.basicConfig(level=logging.DEBUG)
@@ -23,23 +28,85 @@ def extract_spreadsheet_id(google_sheet_link):
         logger.error("Invalid Google Sheets URL")
         raise ValueError("Invalid Google Sheets URL")
 
-# Fetch Basic Google Sheet Data
-def fetch_google_sheet_data(google_sheet_link):
+# Fetch values and text formatting of the first sheet in one request
+def fetch_google_sheet_with_formatting(spreadsheet_id, api_key):
+    url = (f'https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}?ranges=Sheet1'
+           f'&fields=sheets.data.rowData.values(formattedValue,effectiveValue,textFormatRuns)&key={api_key}')
+    logger.info(f"Fetching sheet {spreadsheet_id} with formatting")
+    response = requests.get(url, timeout=settings.SHEETS_REQUEST_TIMEOUT)
+    response.raise_for_status()  # Raises an exception for 4xx/5xx responses
+    return response.json()
+
+# Revision of a spreadsheet, None when Drive does not tell
+def fetch_spreadsheet_revision(spreadsheet_id, api_key):
+    url = f'https://www.googleapis.com/drive/v3/files/{spreadsheet_id}?fields=version&key={api_key}'
+    try:
+        response = requests.get(url, timeout=settings.SHEETS_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json().get('version')
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"Could not read the revision of spreadsheet {spreadsheet_id}: {e}")
+        return None
+
+# Cell values as values:batchGet returns them: formatted strings, trailing empty cells and rows dropped
+def extract_sheet_values(rows):
+    sheet_values = []
+    for row in rows:
+        row_values = [cell.get('formattedValue', '') for cell in row.get('values', [])]
+        while row_values and row_values[-1] == '':
+            row_values.pop()
+        sheet_values.append(row_values)
+    while sheet_values and not sheet_values[-1]:
+        sheet_values.pop()
+    return sheet_values
+
+def load_google_sheet(spreadsheet_id, api_key):
+    data = fetch_google_sheet_with_formatting(spreadsheet_id, api_key)
+    try:
+        rows = data['sheets'][0]['data'][0].get('rowData', [])
+    except (KeyError, IndexError):
+        rows = []
+
+    try:
+        word_color_data = [process_row(row) for row in rows]
+        logger.info("Successfully fetched and processed word color data")
+    except Exception as e:
+        logger.error("Failed to fetch and process word color data: %s", str(e))
+        word_color_data = None
+
+    return {
+        'values': extract_sheet_values(rows),
+        'word_color_data': word_color_data,
+    }
+
+def fetch_google_sheet(google_sheet_link):
     """
-    Fetches basic data from a Google Sheet.
+    Returns {'values', 'word_color_data'} of a Google Sheet from a single
+    request. Results are memoized per spreadsheet ID: for SHEETS_CACHE_TTL
+    seconds no request is made at all, after that the sheet is only downloaded
+    again when its Drive revision changed.
     """
     try:
         spreadsheet_id = extract_spreadsheet_id(google_sheet_link)
-        url = f"https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}/values:batchGet?ranges=Sheet1&key={settings.CREDENTIALS['GOOGLE_API_KEY']}"
-        logger.info(f"Fetching data from URL: {url}")
-        
-        response = requests.get(url)
-        response.raise_for_status()  # Raises an exception for 4xx/5xx responses
-        
-        data = response.json()
-        sheet_values = data['valueRanges'][0].get('values', [])
-        logger.debug(f"Data fetched: {sheet_values}")
-        return sheet_values
+        api_key = settings.CREDENTIALS['GOOGLE_API_KEY']
+        sheet_cache = caches[settings.SHEETS_CACHE]
+        cache_key = f'google-sheet:{spreadsheet_id}'
+
+        entry = sheet_cache.get(cache_key)
+        if entry is not None and time.time() - entry['checked_at'] < settings.SHEETS_CACHE_TTL:
+            logger.info(f"Using cached sheet {spreadsheet_id}")
+            return entry['sheet']
+
+        revision = fetch_spreadsheet_revision(spreadsheet_id, api_key) if settings.SHEETS_REVISION_CHECK else None
+        if entry is not None and revision is not None and entry['revision'] == revision:
+            logger.info(f"Sheet {spreadsheet_id} unchanged at revision {revision}")
+            sheet = entry['sheet']
+        else:
+            sheet = load_google_sheet(spreadsheet_id, api_key)
+
+        sheet_cache.set(cache_key, {'sheet': sheet, 'revision': revision, 'checked_at': time.time()},
+                        settings.SHEETS_CACHE_MAX_AGE)
+        return sheet
     except requests.exceptions.RequestException as e:
         logger.error(f"Request failed: {e}")
         raise Exception(f"Spreadsheet Not Found, Please Use Another Link")
@@ -50,18 +117,43 @@ def fetch_google_sheet_data(google_sheet_link):
         logger.error(f"Unexpected error: {e}")
         raise Exception(f"Unexpected Error Happend, Please Try Again Later")
 
-# Fetch data from Google Sheets API
-def fetch_google_sheet_data_with_formatting(spreadsheet_id, api_key):
-    url = (f'https://sheets.googleapis.com/v4/spreadsheets/{spreadsheet_id}'
-           f'?fields=sheets.data.rowData.values.effectiveValue,sheets.data.rowData.values.textFormatRuns&key={api_key}')
-    
+def prewarm_key(google_sheet_link):
+    return f'google-sheet-prewarm:{hashlib.sha256(google_sheet_link.strip().encode()).hexdigest()}'
+
+def prewarm_google_sheet(google_sheet_link):
+    """
+    Fetches a sheet while its link is validated and keeps the parsed result
+    for the task that is about to be created from it. The task runs in a
+    worker process, so the result goes to the shared SHEETS_CACHE.
+    """
+    sheet = fetch_google_sheet(google_sheet_link)
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error("Failed to fetch data from Google Sheets API: %s", str(e))
-        raise
+        caches[settings.SHEETS_CACHE].set(prewarm_key(google_sheet_link), sheet, settings.SHEETS_PREWARM_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to keep prewarmed sheet: {e}")
+    return sheet
+
+def take_prewarmed_sheet(google_sheet_link):
+    """Returns and forgets the sheet prewarmed for this link, None if there is none."""
+    sheet_cache = caches[settings.SHEETS_CACHE]
+    key = prewarm_key(google_sheet_link)
+    try:
+        sheet = sheet_cache.get(key)
+        if sheet is not None:
+            sheet_cache.delete(key)
+        return sheet
+    except Exception as e:
+        logger.warning(f"Failed to read prewarmed sheet: {e}")
+        return None
+
+# Fetch Basic Google Sheet Data
+def fetch_google_sheet_data(google_sheet_link):
+    """
+    Fetches basic data from a Google Sheet.
+    """
+    sheet_values = fetch_google_sheet(google_sheet_link)['values']
+    logger.debug(f"Data fetched: {sheet_values}")
+    return sheet_values
 
 # Parse text and formatting from a cell
 def parse_cell_text_and_format(cell):
@@ -144,23 +236,38 @@ def process_row(row):
 # Main function to fetch and process word color data
 def extract_word_color_data(google_sheet_link):
     try:
-        # Extract the spreadsheet ID from the URL
-        api_key = settings.CREDENTIALS['GOOGLE_API_KEY']
-        spreadsheet_id = extract_spreadsheet_id(google_sheet_link)
-
-        # Fetch data from Google Sheets API
-        data = fetch_google_sheet_data_with_formatting(spreadsheet_id, api_key)
-        rows = data['sheets'][0]['data'][0]['rowData']
+        return fetch_google_sheet(google_sheet_link)['word_color_data']
+    except Exception as e:
+        logger.error("Failed to fetch and process word color data: %s", str(e))
+        return None
 
-        # Process each row
-        sheet_data = []
-        for row in rows:
-            row_data = process_row(row)
-            sheet_data.append(row_data)
+# Hex string of an RGB color, each color of a sheet is formatted once
+@lru_cache(maxsize=1024)
+def color_to_hex(color):
+    return "#{:02x}{:02x}{:02x}".format(*color)
 
-        logger.info("Successfully fetched and processed word color data")
-        return sheet_data
+# Align the colored words of a row with the parts of its hook text
+def build_word_color_index(row_word_data, hook_text):
+    """
+    Returns one list of (word, color hex) per part split_hook_text makes of
+    hook_text, the color is None when the word is not in the row. Words are
+    matched in order across the row's cells, so the renderer only walks the
+    words of its own hook instead of the sheet data.
+    """
+    tokens = [(word_info['text'].replace('_', '').capitalize(), word_info['color'])
+              for cell in row_word_data or [] if cell
+              for word_info in cell]
 
-    except Exception as e:
-        logger.error("Failed to fetch and process word color data: %s", str(e))
-        return None
\ No newline at end of file
+    position = 0
+    word_color_index = []
+    for part in split_hook_text(hook_text):
+        part_index = []
+        for word in part.split():
+            match = next((i for i in range(position, len(tokens)) if tokens[i][0] == word), None)
+            if match is None:
+                part_index.append((word, None))
+            else:
+                part_index.append((word, color_to_hex(tokens[match][1])))
+                position = match + 1
+        word_color_index.append(part_index)
+    return word_color_index
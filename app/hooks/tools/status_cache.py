@@ -0,0 +1,41 @@
+# Status payloads of hook and merge tasks, cached so status polls rarely reach the database
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+def _cache():
+    return caches[settings.TASK_STATUS_CACHE]
+
+def status_key(model, task_id):
+    return f'task-status:{model._meta.label_lower}:{task_id}'
+
+def refresh_status(model, task_id):
+    """
+    Writes the current status payload of a task to the cache. Called by
+    whoever changes a task's state, returns None if the task does not exist.
+    """
+    task = model.objects.filter(task_id=task_id).first()
+    if task is None:
+        _cache().delete(status_key(model, task_id))
+        return None
+    payload = task.status_payload()
+    try:
+        _cache().set(status_key(model, task_id), payload, settings.TASK_STATUS_CACHE_TIMEOUT)
+    except Exception as e:
+        logging.warning(f"Failed to cache status of task {task_id}: {e}")
+    return payload
+
+def get_status(model, task_id):
+    """Cached status payload of a task, read from the database on a miss."""
+    try:
+        payload = _cache().get(status_key(model, task_id))
+    except Exception as e:
+        logging.warning(f"Failed to read cached status of task {task_id}: {e}")
+        payload = None
+    if payload is None:
+        payload = refresh_status(model, task_id)
+    return payload
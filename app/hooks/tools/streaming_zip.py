@@ -0,0 +1,77 @@
+# Streams a ZIP archive of the output videos without building it in memory
+import logging
+import os
+import zipfile
+
+from django.http import StreamingHttpResponse
+
+logging.basicConfig(level=logging.DEBUG)
+
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+class _ChunkSink:
+    """
+    Write-only file object zipfile writes the archive into. It has no tell()
+    or seek(), so zipfile streams each entry followed by a data descriptor
+    instead of seeking back to patch the local headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(files, chunk_size=ZIP_CHUNK_SIZE):
+    """
+    Yields a ZIP archive of `files`, a list of (path, name in archive) tuples,
+    one chunk at a time. Videos are already compressed so entries are stored,
+    not deflated, and ZIP64 records are written for entries and archives over 4 GiB.
+    """
+    return (chunk for chunk in _zip_chunks(files, chunk_size) if chunk)
+
+def _zip_chunks(files, chunk_size):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for path, arcname in files:
+            if not os.path.exists(path):
+                continue
+            zip_info = zipfile.ZipInfo.from_file(path, arcname)
+            zip_info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as source, zip_file.open(zip_info, 'w') as entry:
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
+
+def zip_response(files, file_name, on_complete=None):
+    """
+    StreamingHttpResponse for stream_zip. `on_complete` runs once the archive
+    was sent or the client went away.
+    """
+    def content():
+        try:
+            yield from stream_zip(files)
+        finally:
+            if on_complete is not None:
+                on_complete()
+
+    response = StreamingHttpResponse(content(), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
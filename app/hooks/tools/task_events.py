@@ -0,0 +1,57 @@
+# Server-Sent Events stream of a task's status, for the processing pages
+import asyncio
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+
+logging.basicConfig(level=logging.DEBUG)
+
+FINAL_STATUSES = ('completed', 'failed')
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+async def _event_stream(snapshot):
+    """
+    Reads the task snapshot on the server every TASK_EVENTS_POLL_INTERVAL
+    seconds and only sends it when it changed. The stream ends once the task
+    is final or after TASK_EVENTS_MAX_SECONDS, EventSource then reconnects.
+    """
+    last = None
+    last_sent_at = time.monotonic()
+    deadline = last_sent_at + settings.TASK_EVENTS_MAX_SECONDS
+    yield f'retry: {settings.TASK_EVENTS_RETRY_MS}\n\n'
+
+    while time.monotonic() < deadline:
+        data = await sync_to_async(snapshot)()
+        if data != last:
+            last = data
+            last_sent_at = time.monotonic()
+            yield format_event('status', data)
+            if data['status'] in FINAL_STATUSES:
+                return
+        elif time.monotonic() - last_sent_at >= settings.TASK_EVENTS_KEEPALIVE:
+            # Comment line, keeps proxies from closing an idle connection
+            last_sent_at = time.monotonic()
+            yield ': keepalive\n\n'
+        await asyncio.sleep(settings.TASK_EVENTS_POLL_INTERVAL)
+
+def task_event_response(request, snapshot):
+    """
+    Streams snapshot() as 'status' events. Under WSGI a long lived stream
+    would pin a worker, so the view answers 204, which tells EventSource to
+    stop and the page to fall back to polling check_task_status.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    response = StreamingHttpResponse(_event_stream(snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # let nginx pass events through immediately
+    return response
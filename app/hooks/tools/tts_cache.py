@@ -0,0 +1,80 @@
+# Content addressed cache for generated voiceovers, shared by every task
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from django.conf import settings
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class TTSCache:
+    """
+    Stores voiceover files under a hash of everything that changes the audio:
+    voice, model, voice settings and the normalized text. The directory is
+    kept under `max_bytes` by deleting the least recently used files.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(voice_id, model_id, voice_settings, text):
+        normalized_text = ' '.join(text.split())
+        payload = json.dumps([voice_id, model_id, voice_settings, normalized_text], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.mp3')
+
+    def fetch(self, key, save_file_path):
+        """Copies the cached voiceover to save_file_path, returns False on a miss."""
+        cached_path = self._path(key)
+        try:
+            shutil.copyfile(cached_path, save_file_path)
+            os.utime(cached_path)  # mark as recently used
+        except FileNotFoundError:
+            return False
+        logging.info(f"Voiceover cache hit {key}")
+        return True
+
+    def store(self, key, audio_file_path):
+        cached_path = self._path(key)
+        temp_path = f'{cached_path}.{threading.get_ident()}.tmp'
+        shutil.copyfile(audio_file_path, temp_path)
+        os.replace(temp_path, cached_path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            try:
+                entries = []
+                for file_name in os.listdir(self.cache_dir):
+                    if file_name.endswith('.mp3'):
+                        stat = os.stat(os.path.join(self.cache_dir, file_name))
+                        entries.append((stat.st_mtime, stat.st_size, file_name))
+                total_bytes = sum(size for _, size, _ in entries)
+                for _, size, file_name in sorted(entries):
+                    if total_bytes <= self.max_bytes:
+                        break
+                    os.remove(os.path.join(self.cache_dir, file_name))
+                    total_bytes -= size
+            except OSError as e:
+                logging.warning(f'Failed to evict voiceover cache entries: {e}')
+
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+def get_tts_cache():
+    global _tts_cache
+    with _tts_cache_lock:
+        if _tts_cache is None:
+            _tts_cache = TTSCache(settings.HOOKS_TTS_CACHE_DIR, settings.HOOKS_TTS_CACHE_MAX_BYTES)
+        return _tts_cache
@@ -1,18 +1,23 @@
 # Utility functions used in video processing
 import logging
 import os
-import shutil
-from moviepy.editor import VideoFileClip, TextClip, ColorClip, CompositeVideoClip ,concatenate_videoclips
+import time
+from moviepy.editor import AudioFileClip, ImageClip, TextClip, ColorClip, CompositeVideoClip ,concatenate_videoclips
 from moviepy.video.fx.all import crop
 from .utils import split_hook_text
-from .font_utils import setup_fontconfig
+from .spreadsheet_extractor import color_to_hex
+from .font_utils import MU_FONT, get_font_registry
+from .overlay_cache import get_overlay_cache
+from .source_pool import get_source_pool
+from .cpu_budget import get_budget
 import numpy as np
-from django.conf import settings
+
+BLACK_HEX = color_to_hex((0, 0, 0))
+WHITE_HEX = color_to_hex((255, 255, 255))
 
 logging.basicConfig(level=logging.DEBUG)
 
-def crop_to_aspect_ratio(video_clip, target_width, target_height):
-    original_width, original_height = video_clip.size
+def compute_crop_box(original_width, original_height, target_width, target_height):
     target_aspect_ratio = target_width / target_height
     original_aspect_ratio = original_width / original_height
 
@@ -31,6 +36,16 @@ def crop_to_aspect_ratio(video_clip, target_width, target_height):
         y2 = int(y_center + new_height / 2)
         x1, x2 = 0, original_width
 
+    return x1, y1, x2, y2
+
+def crop_to_aspect_ratio(video_clip, target_width, target_height):
+    original_width, original_height = video_clip.size
+    # Normalized sources already have the output size
+    if (original_width, original_height) == (target_width, target_height):
+        return video_clip
+
+    x1, y1, x2, y2 = compute_crop_box(original_width, original_height, target_width, target_height)
+
     # Crop the video to the desired aspect ratio
     cropped_clip = crop(video_clip, x1=x1, y1=y1, x2=x2, y2=y2)
 
@@ -40,143 +55,142 @@ def crop_to_aspect_ratio(video_clip, target_width, target_height):
 
     return cropped_clip
 
-def create_custom_text_clip(hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, text_color, font_size, word_color_data):
+def render_text_overlay(pango_text, pango_text2, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, fontsize1, fontsize2):
+    """Renders the colored text bands with ImageMagick and returns them as an RGBA image plus the band heights."""
+    y_multiplier = OUT_VIDEO_HEIGHT / 450
+    min_red_area_h = int(round(40 * y_multiplier))
+    max_width = OUT_VIDEO_WIDTH - 100
+    x_margin = 5
+
+    # Fontconfig is set up once per process by the font registry
+    get_font_registry()
+
+    # Create the text clip with Pango-formatted text for the first part
     try:
-        hook_text_parts = split_hook_text(hook_text)
-        logging.info(f"Hook text parts: {hook_text_parts}")
-        x_multiplier = OUT_VIDEO_WIDTH / 360
-        y_multiplier = OUT_VIDEO_HEIGHT / 450
-        min_red_area_h = int(round(40 * y_multiplier))
-        fontsize1 = int(round(15 * x_multiplier))
-        max_width = OUT_VIDEO_WIDTH - 100
-        logging.info(f'Variables created successfully')
-        x_margin = 5
-
-        # Setup Fontconfig for custom font
-        font_path = os.path.abspath(str(settings.BASE_DIR) + '/dependencies/fonts/mu.otf')
-        logging.info(f"Font path: {font_path}")
-        temp_fontconfig_dir = setup_fontconfig(font_path)
-
-        # Build Pango-formatted text string with color for each word for the first part only
-        pango_text = ""
-        word_index = 0
-        words_in_first_part = hook_text_parts[0].split()
-        text_clips_ = []
-        for word_data in word_color_data:
-            for word_info in word_data:
-                word = word_info['text'].capitalize()  # Capitalize the first letter of the word
-            
-                # Only add the word to pango_text if it is in the first part
-                if word_index < len(words_in_first_part) and word == words_in_first_part[word_index].capitalize():
-                    color = word_info['color']
-
-                    # Override the color only if it's not black
-                    if color == (0, 0, 0):
-                        color = text_color  # Use the front-end color if the color is black
-
-                    color_hex = "#{:02x}{:02x}{:02x}".format(*color)
-
-                    # Apply the font directly in Pango markup
-                    pango_text += f'<span font_desc="Mu Font {fontsize1}" foreground="{color_hex}">{word}</span> '
-                    word_index += 1
-        logging.info(f"Pango-formatted text: {pango_text}")
-
-        # Create the text clip with Pango-formatted text for the first part
-        try:
-            text_clip1 = TextClip(
-            pango_text.strip(),  # Pango-formatted string with word colors
-            size=( max_width , None),
-            method='pango',  # Enable Pango markup
-            fontsize=fontsize1,
-            color='white',  # Default color, overridden by Pango markup
-            align='center'
-            )
-            logging.info(f"Debug: Created TextClip with size: {text_clip1.size}")
-        except Exception as e:
-            logging.error(f"Error creating TextClip: {e}")
-            raise
-
-        # Get the dimensions of the first text clip
-        text_clip1_w, text_clip1_h = text_clip1.size
-        if text_clip1_h > (min_red_area_h - 10):
-            min_red_area_h = text_clip1_h + 10
-
-        # Create background clip for the first part
-        bg_clip1 = ColorClip(size=(OUT_VIDEO_WIDTH, min_red_area_h), color=top_box_color)
-
-        text_clip1_y_offset = (min_red_area_h - text_clip1_h) / 2
+        text_clip1 = TextClip(
+        pango_text.strip(),  # Pango-formatted string with word colors
+        size=( max_width , None),
+        method='pango',  # Enable Pango markup
+        fontsize=fontsize1,
+        color='white',  # Default color, overridden by Pango markup
+        align='center'
+        )
+        logging.info(f"Debug: Created TextClip with size: {text_clip1.size}")
+    except Exception as e:
+        logging.error(f"Error creating TextClip: {e}")
+        raise
+
+    # Get the dimensions of the first text clip
+    text_clip1_w, text_clip1_h = text_clip1.size
+    if text_clip1_h > (min_red_area_h - 10):
+        min_red_area_h = text_clip1_h + 10
+
+    # Create background clip for the first part
+    bg_clip1 = ColorClip(size=(OUT_VIDEO_WIDTH, min_red_area_h), color=top_box_color)
+
+    text_clip1_y_offset = (min_red_area_h - text_clip1_h) / 2
+
+    final_clip = CompositeVideoClip([
+        bg_clip1.set_position((0, 0)),
+        text_clip1.set_position(("center", text_clip1_y_offset)),
+    ], size=(OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT))
+    band_heights = {'top': min_red_area_h, 'bottom': 0}
+
+    # Process the second part (after the hyphen) if it exists
+    if pango_text2 is not None:
+        min_white_area_h = int(round(30 * y_multiplier))
+
+        # Create TextClip for the second part with Pango-formatted text
+        text_clip2 = TextClip(pango_text2.strip(),
+                          size=(OUT_VIDEO_WIDTH - (x_margin * 2), 0),
+                          method='pango',  # Enable Pango markup
+                          fontsize=fontsize2,
+                          color='black',  # Default color, overridden by Pango markup
+                          align='center',)
+        text_clip2_w, text_clip2_h = text_clip2.size
+        if text_clip2_h > min_white_area_h:
+            min_white_area_h = text_clip2_h
+
+        # Create background clip for the second part
+        bg_clip2 = ColorClip(size=(OUT_VIDEO_WIDTH, min_white_area_h), color=(255, 255, 255))
+
+        text_clip2_y_offset = min_red_area_h + (min_white_area_h - text_clip2_h) / 2
 
         final_clip = CompositeVideoClip([
             bg_clip1.set_position((0, 0)),
-            text_clip1.set_position(("center", text_clip1_y_offset)),
+            bg_clip2.set_position((0, min_red_area_h)),
+            text_clip1.set_position(('center', text_clip1_y_offset)),
+            text_clip2.set_position((x_margin, text_clip2_y_offset)),
         ], size=(OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT))
-
-        # Process the second part (after the hyphen) if it exists
-        if len(hook_text_parts) > 1:
-            min_white_area_h = int(round(30 * y_multiplier))
-            fontsize2 = int(round(20 * 0.7 * x_multiplier))
-            second_part_text = hook_text_parts[1]
-
-            # Build Pango-formatted text string with color for the second part
-            pango_text2 = ""
-            word_index_second = 0
-            words_in_second_part = second_part_text.split()
-            for word_info in word_data:
-                word = word_info['text'].capitalize()
-
-                # Ensure word is part of the second part
-                if word_index_second < len(words_in_second_part) and word == words_in_second_part[word_index_second].capitalize():
-                    color = word_info['color']
-                    if color == (255, 255, 255):
-                        color = (0, 0, 0)  # Use default color if the color is black
-
-                    color_hex = "#{:02x}{:02x}{:02x}".format(*color)
-
-                    
-                    pango_text2 += f'<span font_desc="Mu Font {fontsize2}" foreground="{color_hex}">{word}</span> '
-                    word_index_second += 1
-            # Create TextClip for the second part with Pango-formatted text
-            text_clip2 = TextClip(pango_text2.strip(),
-                              size=(OUT_VIDEO_WIDTH - (x_margin * 2), 0),
-                              method='pango',  # Enable Pango markup
-                              fontsize=fontsize2,
-                              color='black',  # Default color, overridden by Pango markup
-                              align='center',)
-            text_clip2_w, text_clip2_h = text_clip2.size
-            if text_clip2_h > min_white_area_h:
-                min_white_area_h = text_clip2_h
-
-            # Create background clip for the second part
-            bg_clip2 = ColorClip(size=(OUT_VIDEO_WIDTH, min_white_area_h), color=(255, 255, 255))
-
-            text_clip2_y_offset = min_red_area_h + (min_white_area_h - text_clip2_h) / 2
-
-            final_clip = CompositeVideoClip([
-                bg_clip1.set_position((0, 0)),
-                bg_clip2.set_position((0, min_red_area_h)),
-                text_clip1.set_position(('center', text_clip1_y_offset)),
-                text_clip2.set_position((x_margin, text_clip2_y_offset)),
-            ], size=(OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT))
-
-        # Clean up the temporary Fontconfig directory
-        try:
-            shutil.rmtree(temp_fontconfig_dir)
-        except Exception as err:
-            logging.error(f"Error removing Fontconfig directory: {err}")
-
-        return final_clip
+        band_heights['bottom'] = min_white_area_h
+
+    # Flatten the overlay to a single RGBA frame, the mask becomes the alpha channel
+    rgb = final_clip.get_frame(0).astype('uint8')
+    alpha = (final_clip.mask.get_frame(0) * 255).astype('uint8')
+    rgba = np.dstack([rgb, alpha])
+
+    return rgba, band_heights
+
+def get_text_overlay(hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, text_color, font_size, word_color_index):
+    """
+    Returns the cached OverlayEntry for the hook text, rendering it on a cache miss.
+    word_color_index comes from spreadsheet_extractor.build_word_color_index.
+    """
+    hook_text_parts = split_hook_text(hook_text)
+    logging.info(f"Hook text parts: {hook_text_parts}")
+    x_multiplier = OUT_VIDEO_WIDTH / 360
+    fontsize1 = int(round(15 * x_multiplier))
+    fontsize2 = int(round(20 * 0.7 * x_multiplier))
+
+    # An index built for another text is ignored, every word then gets the default color
+    word_color_index = word_color_index or []
+    if [[word for word, _ in part] for part in word_color_index] != [part.split() for part in hook_text_parts]:
+        word_color_index = [[(word, None) for word in part.split()] for part in hook_text_parts]
+
+    # First part: black or missing colors use the front-end color
+    text_color_hex = color_to_hex(tuple(text_color))
+    word_colors1 = [(word, text_color_hex if color in (None, BLACK_HEX) else color)
+                    for word, color in word_color_index[0]]
+    # Apply the font directly in Pango markup
+    pango_text = ''.join(f'<span font_desc="{MU_FONT} {fontsize1}" foreground="{color}">{word}</span> '
+                         for word, color in word_colors1)
+    logging.info(f"Pango-formatted text: {pango_text}")
+
+    # Second part (after the hyphen) if it exists: white or missing colors are drawn black on the white band
+    pango_text2 = None
+    word_colors2 = []
+    if len(hook_text_parts) > 1:
+        word_colors2 = [(word, BLACK_HEX if color in (None, WHITE_HEX) else color)
+                        for word, color in word_color_index[1]]
+        pango_text2 = ''.join(f'<span font_desc="{MU_FONT} {fontsize2}" foreground="{color}">{word}</span> '
+                              for word, color in word_colors2)
+
+    overlay_cache = get_overlay_cache()
+    key = overlay_cache.make_key(hook_text_parts, word_colors1, word_colors2, top_box_color,
+                                 MU_FONT, fontsize1, fontsize2, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT)
+    entry = overlay_cache.get(key)
+    if entry is not None:
+        logging.info(f"Using cached text overlay {key}")
+        return entry
+
+    rgba, band_heights = render_text_overlay(pango_text, pango_text2, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT,
+                                             top_box_color, fontsize1, fontsize2)
+    return overlay_cache.put(key, rgba, band_heights)
+
+def create_custom_text_clip(hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, text_color, font_size, word_color_index):
+    try:
+        entry = get_text_overlay(hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, text_color, font_size, word_color_index)
+        mask = ImageClip(entry.rgba[:, :, 3] / 255.0, ismask=True)
+        return ImageClip(entry.rgba[:, :, :3]).set_mask(mask)
 
     except Exception as e:
         logging.error(f"Error in create_custom_text_clip: {e}")
         raise
 
 
-def process_audio_on_videos(row, video_files, idx, input_df, hook_number, hook_text, num_videos_to_use, audio_clip, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, output_videos_folder, total_rows, task_id, top_box_color, default_text_color, word_color_data,audio_file=None):
+def process_audio_on_videos(video_files, idx, hook_number, hook_text, num_videos_to_use, audio_clip, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, output_videos_folder, total_rows, task_id, top_box_color, default_text_color, word_color_index):
     # Remove underscores from the hook text for display
     cleaned_hook_text = hook_text.replace('_', '')
-
-    row['Input Video Filename'] = [os.path.basename(considered_video) for considered_video in video_files]
-    input_df.at[idx, 'Input Video Filename'] = row['Input Video Filename']
     
     # Ensure num_videos_to_use is valid and non-zero
     if num_videos_to_use <= 0:
@@ -187,67 +201,103 @@ def process_audio_on_videos(row, video_files, idx, input_df, hook_number, hook_t
     video_clips = []
     logging.debug(f"Audio clip duration: {audio_clip.duration}, num_videos_to_use: {num_videos_to_use}")
 
-    for considered_vid in video_files:
-        try:
-            # Ensure the video file exists
-            if not os.path.exists(considered_vid):
-                logging.error(f"Video file {considered_vid} does not exist.")
-                continue
-
-            # Log and process the video
-            logging.info(f'Processing video: {considered_vid}')
-            video_clip = VideoFileClip(considered_vid).subclip(0, each_video_duration)
-
-            # Check if the video clip has valid duration
-            if video_clip.duration <= 0:
-                logging.error(f"Video {considered_vid} has invalid duration {video_clip.duration}. Skipping.")
+    # Readers are opened through the task's pool and closed once the hook is written
+    source_pool = get_source_pool(task_id)
+    acquired = []
+    try:
+        for considered_vid in video_files:
+            try:
+                # Ensure the video file exists
+                if not os.path.exists(considered_vid):
+                    logging.error(f"Video file {considered_vid} does not exist.")
+                    continue
+
+                # Log and process the video
+                logging.info(f'Processing video: {considered_vid}')
+                source_clip = source_pool.acquire(considered_vid)
+                acquired.append((considered_vid, source_clip))
+                video_clip = source_clip.subclip(0, each_video_duration)
+
+                # Check if the video clip has valid duration
+                if video_clip.duration <= 0:
+                    logging.error(f"Video {considered_vid} has invalid duration {video_clip.duration}. Skipping.")
+                    continue
+
+                # Apply cropping to maintain aspect ratio without distortion
+                video_clip = crop_to_aspect_ratio(video_clip, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT)
+
+                # Add the clip to the list of video clips
+                video_clips.append(video_clip)
+            except Exception as e:
+                logging.error(f"Error processing video {considered_vid}: {e}")
                 continue
-
-            # Apply cropping to maintain aspect ratio without distortion
-            video_clip = crop_to_aspect_ratio(video_clip, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT)
-
-            # Add the clip to the list of video clips
-            video_clips.append(video_clip)
-        except Exception as e:
-            logging.error(f"Error processing video {considered_vid}: {e}")
-            continue
     
-    # Ensure there are valid clips to concatenate
-    if not video_clips:
-        logging.error("No valid video clips were found for concatenation.")
-        return None
+        # Ensure there are valid clips to concatenate
+        if not video_clips:
+            logging.error("No valid video clips were found for concatenation.")
+            return None
     
-    logging.info('Concatenating videos')
-    final_video_clip = concatenate_videoclips(video_clips)
-    logging.info('Concatenated videos')
+        logging.info('Concatenating videos')
+        final_video_clip = concatenate_videoclips(video_clips)
+        logging.info('Concatenated videos')
 
-    # Automatically adjust the font size based on video dimensions and text length
-    auto_font_size = max(int(OUT_VIDEO_WIDTH / len(cleaned_hook_text) * 1.5), 20)  # Simple logic to adjust font size
+        # Automatically adjust the font size based on video dimensions and text length
+        auto_font_size = max(int(OUT_VIDEO_WIDTH / len(cleaned_hook_text) * 1.5), 20)  # Simple logic to adjust font size
 
-    # Ensure correct word color data is used
-    if idx < len(word_color_data):
-        specific_word_color_data = word_color_data[idx]
-    else:
-        specific_word_color_data = []  # Fallback to an empty list if out of range (for safety)
-
-    logging.info(f"Specific word color data: {specific_word_color_data}")
-    # Pass specific_word_color_data to the custom text clip creation
-    logging.info('Using the create_custom_text_clip method')
-    custom_text_clip = create_custom_text_clip(cleaned_hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, default_text_color, auto_font_size, specific_word_color_data)
-    logging.info('Used the create_custom_text_clip method')
+        logging.info(f"Word color index: {word_color_index}")
+        # Pass word_color_index to the custom text clip creation
+        logging.info('Using the create_custom_text_clip method')
+        custom_text_clip = create_custom_text_clip(cleaned_hook_text, OUT_VIDEO_WIDTH, OUT_VIDEO_HEIGHT, top_box_color, default_text_color, auto_font_size, word_color_index)
+        logging.info('Used the create_custom_text_clip method')
 
-    logging.info('Creating a CompositeVideoClip instance')
-    final_clip = CompositeVideoClip([
-        final_video_clip.audio_fadein(0.2).audio_fadeout(0.2),
-        final_video_clip,
-        custom_text_clip
-    ]).set_audio(audio_clip).set_duration(audio_clip.duration)
-    logging.info("Created a CompositeVideoClip instance")
+        logging.info('Creating a CompositeVideoClip instance')
+        final_clip = CompositeVideoClip([
+            final_video_clip.audio_fadein(0.2).audio_fadeout(0.2),
+            final_video_clip,
+            custom_text_clip
+        ]).set_audio(audio_clip).set_duration(audio_clip.duration)
+        logging.info("Created a CompositeVideoClip instance")
 
 
-    output_video_filename = os.path.join(output_videos_folder, f'hook_{idx}.mp4')
-    logging.info(f"{output_videos_folder},'---------->output_videos_folder")
+        output_video_filename = os.path.join(output_videos_folder, f'hook_{idx}.mp4')
+        logging.info(f"{output_videos_folder},'---------->output_videos_folder")
 
-    final_clip.write_videofile(output_video_filename, temp_audiofile=os.path.join(output_videos_folder, f"temp-audio_{idx}.m4a"), remove_temp=False, codec='libx264', audio_codec="aac")
+        with get_budget().encode(expected=True) as threads:
+            final_clip.write_videofile(output_video_filename, temp_audiofile=os.path.join(output_videos_folder, f"temp-audio_{idx}.m4a"), remove_temp=False, codec='libx264', audio_codec="aac", threads=threads)
+    finally:
+        for considered_vid, source_clip in acquired:
+            source_pool.release(considered_vid, source_clip)
 
     logging.info(f"Video processing completed successfully")
+    return output_video_filename
+
+def render_hook(job):
+    """
+    Renders a single hook from a picklable job dict so it can run in a worker
+    thread or a worker process. Only the manifest fields and the output path
+    are sent back to the caller.
+    """
+    started_at = time.monotonic()
+    if job.get('render_backend') == 'ffmpeg':
+        from .ffmpeg_renderer import render_hook_ffmpeg
+        output_path = render_hook_ffmpeg(job)
+    else:
+        output_path = render_hook_moviepy(job)
+
+    return {
+        'idx': job['idx'],
+        'Input Video Filename': [os.path.basename(video_file) for video_file in job['video_files']],
+        'output_path': output_path,
+        'render_seconds': round(time.monotonic() - started_at, 2),
+    }
+
+def render_hook_moviepy(job):
+    audio_clip = AudioFileClip(job['audio_path'])
+    try:
+        output_path = process_audio_on_videos(job['video_files'], job['idx'], job['hook_number'], job['hook_text'],
+                                              job['num_videos_to_use'], audio_clip, job['width'], job['height'],
+                                              job['output_videos_folder'], job['total_rows'], job['task_id'],
+                                              job['top_box_color'], job['default_text_color'], job['word_color_index'])
+    finally:
+        audio_clip.close()
+    return output_path
@@ -1,28 +1,30 @@
 import logging
-import tempfile
 import os
 
 from django.shortcuts import render, redirect
+from django.conf import settings
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, Http404
 
 from .forms import HookForm
 
 from .tools.utils import generate_task_id
 from .tools.processor import process_files
+from .tools.checkpoints import TaskCheckpoints, task_work_dir
 
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 
 from .models import Task
-
-import threading
-
-import zipfile
-import io
+from .tools.job_queue import get_queue, ensure_worker_pool
+from .tools.streaming_zip import zip_response
+from .tools.file_serving import serve_file
+from .tools.task_events import task_event_response
+from .tools.status_cache import get_status, refresh_status
 
 import requests
-from .tools.spreadsheet_extractor import fetch_google_sheet_data
+from .tools.spreadsheet_extractor import prewarm_google_sheet
 
 
 
@@ -31,26 +33,38 @@ logging.basicConfig(level=logging.DEBUG)
 def background_processing(task_id, user_profile):
 
     try:
-        temp_dir = tempfile.mkdtemp(prefix=f"task_{task_id}_")
+        # Same directory on every attempt, so a resumed task finds its checkpointed files
+        temp_dir = task_work_dir(task_id)
+        os.makedirs(temp_dir, exist_ok=True)
         logging.info(f'temp_dir ->, {temp_dir}')
 
-        # Process the files and get video links and credits used
-        video_links, credits_used = process_files(temp_dir, task_id)
+        # Process the files and get the links of the rendered hooks and the hooks to charge
+        video_links, to_charge, failed_hooks = process_files(temp_dir, task_id)
         logging.info(f"{video_links}: Video Links")
+        credits_used = len(to_charge)
         logging.info(f'{credits_used} Credits Used.')
 
-        # Reduce user credits and save profile
-        user_profile.credits -= credits_used
-        user_profile.save()
+        with transaction.atomic():
+            # Reduce user credits and save profile, one credit per rendered hook
+            user_profile.credits -= credits_used
+            user_profile.save()
+            TaskCheckpoints(task_id).mark_charged(to_charge)
 
-        # Update the task status
-        task = Task.objects.get(task_id=task_id)
-        task.status = 'completed'
-        task.video_links = video_links
-        task.save()
+            # A task with failed hooks stays resumable, only its missing hooks are redone
+            task = Task.objects.get(task_id=task_id)
+            task.status = 'failed' if failed_hooks else 'completed'
+            task.video_links = video_links
+            task.save()
+        refresh_status(Task, task_id)
 
     except Exception as e:
         logging.error(f"Error during background processing: {e}")
+        Task.objects.filter(task_id=task_id).update(status='failed')
+        refresh_status(Task, task_id)
+
+def run_hook_task(task):
+    # Job queue handler, runs on a worker instead of the request thread
+    background_processing(task.task_id, task.user.profile)
 
 @login_required
 def upload_hook(request):
@@ -70,6 +84,7 @@ def upload_hook(request):
             hook = form.save(commit=False)
             hook.task_id = task_id
             hook.parallel_processing = parallel_processing
+            hook.render_backend = settings.HOOKS_RENDER_BACKEND
             hook.save()
             
             return redirect('hooks:processing', task_id=task_id)  # Redirect to a processing page after form submission
@@ -89,9 +104,8 @@ def processing(request, task_id):
         # return redirect('hooks:no_credits')  # Redirect to an error page or appropriate view
         return HttpResponse("You don't have enough credits, buy and try again!", status=404)
     
-    thread = threading.Thread(target=background_processing,
-                              args=(task_id, user_profile))
-    thread.start()
+    get_queue('hooks').enqueue(task_id, user=request.user)
+    ensure_worker_pool()
     
     return render(request, 
                 'processing.html', 
@@ -100,13 +114,18 @@ def processing(request, task_id):
 
 @login_required
 def check_task_status(request, task_id):
-    task = get_object_or_404(Task, task_id=task_id)
-    
-    # Return task status and video links (if processing is completed)
-    return JsonResponse({
-        'status': task.status,
-        'video_links': task.video_links if task.status == 'completed' else None
-    })
+    # Workers keep the cached payload up to date, the database is only read on a miss
+    payload = get_status(Task, task_id)
+    if payload is None:
+        raise Http404("Task not found")
+    return JsonResponse(payload)
+
+@login_required
+def task_events(request, task_id):
+    # Pushes the same payload as check_task_status whenever it changes (ASGI only)
+    if get_status(Task, task_id) is None:
+        raise Http404("Task not found")
+    return task_event_response(request, lambda: get_status(Task, task_id))
 
 def processing_successful(request, task_id):
      task = get_object_or_404(Task, task_id=task_id)
@@ -117,42 +136,17 @@ def processing_successful(request, task_id):
                 'video_links': task.video_links})    
 
 def download_video(request, videopath):
-    # Decode the path
-    # videopath = os.path.join(settings.BASE_DIR.parent, videopath)
-
-    
-    # Check if the video file exists
-    if not os.path.exists(videopath):
-        return HttpResponse("Video not found", status=404)
-
-    # Return the file as a download
-    response = FileResponse(open(videopath, 'rb'), content_type='video/mp4')
-    response['Content-Disposition'] = f'attachment; filename="{os.path.basename(videopath)}"'
-    
-    return response
+    # Ranges, conditional requests and proxy offload are handled by serve_file
+    return serve_file(request, videopath)
 
 def download_zip(request, task_id):
 
     task = get_object_or_404(Task, task_id=task_id)
     videos = task.video_links
 
-    zip_buffer = io.BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        for idx, video in enumerate(videos):
-            if os.path.exists(video['video_link']):
-                file_name = os.path.basename(video['video_link'])
-
-                # Add the file to the zip archive
-                zip_file.write(video['video_link'], file_name)
-
-    zip_buffer.seek(0)
-
-    # Create a response with the zip file for downloading
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="hook_videos.zip"'
-
-    return response
+    # Stream the archive as it is written instead of building it in memory first
+    files = [(video['video_link'], os.path.basename(video['video_link'])) for video in videos]
+    return zip_response(files, 'hook_videos.zip')
 
 @login_required
 def validate_google_sheet_link(request):
@@ -160,8 +154,9 @@ def validate_google_sheet_link(request):
         google_sheets_link = request.POST.get('google_sheets_link')
         
         try:
-            # Attempt to fetch the Google Sheets data for validation
-            fetch_google_sheet_data(google_sheets_link)
+            # Attempt to fetch the Google Sheets data for validation, the task created
+            # from this link starts from the fetched data
+            prewarm_google_sheet(google_sheets_link)
             return JsonResponse({'valid': True})
         except ValueError as ve:
             return JsonResponse({'valid': False, 'error': str(ve)})
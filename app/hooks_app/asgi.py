@@ -3,6 +3,10 @@ ASGI config for hooks_app project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The processing pages' task event streams (Server-Sent Events) are only
+pushed when the project is served through this application by an ASGI server;
+under WSGI the pages fall back to polling check_task_status.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -88,6 +88,27 @@ DATABASES = {
     }
 }
 
+# Caches
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# task_status is file based so web and run_workers processes on one host share it,
+# point it at Redis or Memcached when they run on several hosts
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'task_status': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'media', 'cache', 'task_status'),
+    },
+    # Fetched and prewarmed Google Sheets, shared by the web and worker processes
+    'sheets': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'media', 'cache', 'sheets'),
+        'OPTIONS': {'MAX_ENTRIES': 1000},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -150,6 +171,104 @@ if not os.path.exists(UPLOAD_FOLDER):
 if not os.path.exists(OUTPUT_FOLDER):
     os.makedirs(OUTPUT_FOLDER)
 
+# Background job queue, processed by dedicated `python manage.py run_workers` processes.
+# JOB_QUEUE_IN_PROCESS_WORKERS = True instead starts a pool inside each web process when a
+# task is queued, only meant for a single process development server
+JOB_QUEUE_WORKERS = 2
+JOB_QUEUE_IN_PROCESS_WORKERS = False
+JOB_QUEUE_POLL_INTERVAL = 2  # seconds
+JOB_QUEUE_LEASE_SECONDS = 120
+JOB_QUEUE_MAX_ATTEMPTS = 3
+JOB_QUEUE_CLEANUP_INTERVAL = 3600  # seconds between runs of the queues' cleanup functions
+
+# Hook rendering
+# 'process' renders each hook in a worker process, 'thread' renders in threads of the job worker
+HOOKS_RENDER_EXECUTOR = 'process'
+HOOKS_RENDER_WORKERS = None  # None uses one worker per CPU core
+HOOKS_PIPELINE_QUEUE_SIZE = 8  # hooks with a finished voiceover waiting for a render slot
+# Render engine for new tasks: 'moviepy' composites frames in Python, 'ffmpeg' runs one filtergraph per hook
+HOOKS_RENDER_BACKEND = 'moviepy'
+# Rendered text overlays are reused across hooks and tasks
+HOOKS_OVERLAY_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'overlays')
+HOOKS_OVERLAY_CACHE_MEMORY_ENTRIES = 32
+HOOKS_OVERLAY_CACHE_DISK_ENTRIES = 2000
+HOOKS_FONTCONFIG_DIR = os.path.join(MEDIA_ROOT, 'cache', 'fontconfig')
+# Tasks whose source video metadata stays cached in each render process
+HOOKS_SOURCE_POOLS_PER_PROCESS = 2
+# Transcode each uploaded video once to the output size and frame rate before rendering hooks
+HOOKS_NORMALIZE_SOURCES = True
+HOOKS_NORMALIZED_FPS = 30
+# Seconds of each source that are normalized. Hooks read one slice from the start of a source,
+# a hook whose slice is longer (few sources, long voiceover) renders from the uploaded files
+HOOKS_NORMALIZE_MAX_SECONDS = 30
+
+# ffprobe used to fill the media probe index, moviepy's ffmpeg is used when it is missing
+FFPROBE_BINARY = 'ffprobe'
+
+# Encoder threads shared by all concurrent ffmpeg/x264 encodes (hooks, merges and ingest) of a
+# worker process and its render processes, None uses every core. Each encode gets the total
+# divided by the encodes and renders in flight. Split it when several `run_workers` processes
+# share a machine
+ENCODE_THREADS_TOTAL = None
+
+# Merger: 'copy' encodes every input once and joins each pair with the concat demuxer,
+# 'reencode' re-encodes every short/large pair with the concat filter
+MERGER_CONCAT_MODE = 'copy'
+
+# Merger: concurrent preprocess/concat jobs (None uses the core count) and retries of a failed job
+MERGER_WORKERS = None
+MERGER_JOB_RETRIES = 1
+
+# Cache for task status payloads, written by the workers on every state change and read by
+# check_task_status before the database. It must be shared by the web and worker processes
+TASK_STATUS_CACHE = 'task_status'
+TASK_STATUS_CACHE_TIMEOUT = 300
+
+# Seconds between progress writes to the Task row while hooks are processed
+HOOKS_PROGRESS_FLUSH_SECONDS = 2
+
+# Working directories of hook tasks. They are kept after a failure so a resumed
+# task (`python manage.py resume_tasks`) reuses the checkpointed voiceovers and videos
+HOOKS_WORK_DIR = os.path.join(MEDIA_ROOT, 'work', 'hooks')
+
+# Seconds a task's working directory is kept after its last write, completed tasks serve
+# their downloads from it, failed ones can be resumed. Deleted by the job queue workers
+# every JOB_QUEUE_CLEANUP_INTERVAL or by `python manage.py cleanup_work_dirs`
+HOOKS_WORK_DIR_RETENTION = 2 * 24 * 3600
+HOOKS_FAILED_WORK_DIR_RETENTION = 7 * 24 * 3600
+
+# Processing pages: server side status checks of the event stream, keepalive comments,
+# reconnect delay sent to EventSource and how long one stream stays open
+TASK_EVENTS_POLL_INTERVAL = 1
+TASK_EVENTS_KEEPALIVE = 15
+TASK_EVENTS_RETRY_MS = 3000
+TASK_EVENTS_MAX_SECONDS = 600
+
+# Hand video downloads to the front proxy: None, 'X-Sendfile' (Apache/lighttpd) or 'X-Accel-Redirect' (nginx)
+SENDFILE_HEADER = None
+# For X-Accel-Redirect, the internal nginx location serving each folder
+SENDFILE_INTERNAL_LOCATIONS = {
+    OUTPUT_FOLDER: '/protected/output',
+    HOOKS_WORK_DIR: '/protected/hooks',
+}
+
+# Google Sheets: cache alias for fetched sheets, seconds a fetched sheet is reused without any
+# request, whether to compare the Drive revision after that, and how long entries are kept
+SHEETS_CACHE = 'sheets'
+SHEETS_CACHE_TTL = 300
+SHEETS_REVISION_CHECK = True
+SHEETS_CACHE_MAX_AGE = 24 * 60 * 60
+SHEETS_REQUEST_TIMEOUT = (10, 60)
+# Sheets fetched while validating a link, kept in SHEETS_CACHE for the task created right after
+SHEETS_PREWARM_TTL = 15 * 60
+
+# ElevenLabs text to speech
+ELEVENLABS_API_URL = 'https://api.elevenlabs.io'
+ELEVENLABS_CONCURRENCY = 4  # parallel requests (and pooled connections) per API key
+ELEVENLABS_TIMEOUT = (10, 120)  # connect and read timeouts in seconds
+HOOKS_TTS_CACHE_DIR = os.path.join(MEDIA_ROOT, 'cache', 'voiceovers')
+HOOKS_TTS_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
 # DATA_UPLOAD_MAX_MEMORY_SIZE = None  
 # FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024 * 1024  # 10 GB
 
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MergerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'merger'
+
+    def ready(self):
+        from hooks.tools.job_queue import register_queue
+        register_queue('merge', self.get_model('MergeTask'), 'merger.views.run_merge_task')
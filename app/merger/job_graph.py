@@ -0,0 +1,109 @@
+# Runs the ffmpeg steps of a merge as a dependency graph on a bounded thread pool
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class JobNode:
+    def __init__(self, name, fn, args, deps, retries):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.deps = list(deps)
+        self.retries = retries
+        self.dependents = []
+        self.status = PENDING
+        self.attempts = 0
+        self.started_at = None
+        self.seconds = None
+        self.error = None
+
+
+class JobGraph:
+    """
+    A node is submitted as soon as all of its dependencies completed, so a
+    concat starts while other inputs are still being prepared. A failing node
+    is retried up to `retries` times; after that it and everything depending
+    on it are marked failed/skipped while unrelated nodes keep running.
+    """
+
+    def __init__(self, max_workers, retries=0):
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.nodes = {}
+
+    def add(self, name, fn, *args, deps=(), retries=None):
+        for dep in deps:
+            if dep not in self.nodes:
+                raise ValueError(f"Unknown dependency {dep} of job {name}")
+        node = JobNode(name, fn, args, deps, self.retries if retries is None else retries)
+        for dep in deps:
+            self.nodes[dep].dependents.append(node)
+        self.nodes[name] = node
+        return node
+
+    def _execute(self, node):
+        node.attempts += 1
+        node.started_at = node.started_at or time.monotonic()
+        return node.fn(*node.args)
+
+    def _skip(self, node, reason, on_done):
+        for dependent in node.dependents:
+            if dependent.status == PENDING:
+                dependent.status = SKIPPED
+                dependent.error = reason
+                on_done(dependent)
+                self._skip(dependent, reason, on_done)
+
+    def run(self, on_done=None):
+        """Runs every node and calls on_done(node) from this thread whenever a node finishes."""
+        on_done = on_done or (lambda node: None)
+        running = {}
+
+        def ready(node):
+            return node.status == PENDING and all(self.nodes[dep].status == COMPLETED for dep in node.deps)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def submit(node):
+                node.status = RUNNING
+                running[executor.submit(self._execute, node)] = node
+
+            for node in self.nodes.values():
+                if ready(node):
+                    submit(node)
+
+            while running:
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if node.attempts <= node.retries:
+                            logging.warning(f"Job {node.name} failed (attempt {node.attempts}), retrying --> {e}")
+                            submit(node)
+                            continue
+                        logging.error(f"Job {node.name} failed --> {e}")
+                        node.status = FAILED
+                        node.error = str(e)
+                    else:
+                        node.status = COMPLETED
+                    node.seconds = round(time.monotonic() - node.started_at, 2)
+                    on_done(node)
+
+                    if node.status == FAILED:
+                        self._skip(node, f"{node.name} failed", on_done)
+                    else:
+                        for dependent in node.dependents:
+                            if ready(dependent):
+                                submit(dependent)
+
+        return self.nodes
@@ -1,11 +1,20 @@
 from django.db import models
+from hooks.models import QueuedJob
 
-class MergeTask(models.Model):
-    task_id = models.CharField(max_length=255)
+class MergeTask(QueuedJob):
+    task_id = models.CharField(max_length=255, db_index=True)
     status = models.CharField(max_length=20, default='processing')
     short_video_path = models.JSONField(null=True, blank=True)
     large_video_paths = models.JSONField(null=True, blank=True)
     video_links = models.JSONField(null=True, blank=True)
 
+    def status_payload(self):
+        # Returned by check_task_status and cached by hooks.tools.status_cache,
+        # video_links carries the per-output status filled in as pairs finish
+        return {
+            'status': self.status,
+            'video_links': self.video_links
+        }
+
     def __str__(self) -> str:
         return self.status
@@ -1,3 +1,68 @@
-from django.test import TestCase
+import threading
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .job_graph import JobGraph, COMPLETED, FAILED, SKIPPED
+
+
+class JobGraphTests(SimpleTestCase):
+
+    def test_runs_dependencies_first(self):
+        order = []
+        lock = threading.Lock()
+
+        def step(name):
+            with lock:
+                order.append(name)
+
+        graph = JobGraph(max_workers=4)
+        graph.add('short', step, 'short')
+        graph.add('large', step, 'large')
+        graph.add('concat', step, 'concat', deps=('short', 'large'))
+        nodes = graph.run()
+
+        self.assertEqual(order[-1], 'concat')
+        self.assertEqual({node.status for node in nodes.values()}, {COMPLETED})
+
+    def test_failure_skips_only_dependents(self):
+        def broken():
+            raise Exception('bad input')
+
+        done = []
+        graph = JobGraph(max_workers=2)
+        graph.add('broken', broken)
+        graph.add('good', lambda: None)
+        graph.add('concat_broken', lambda: None, deps=('broken',))
+        graph.add('final_broken', lambda: None, deps=('concat_broken',))
+        graph.add('concat_good', lambda: None, deps=('good',))
+        nodes = graph.run(on_done=lambda node: done.append(node.name))
+
+        self.assertEqual(nodes['broken'].status, FAILED)
+        self.assertEqual(nodes['broken'].error, 'bad input')
+        self.assertEqual(nodes['concat_broken'].status, SKIPPED)
+        self.assertEqual(nodes['final_broken'].status, SKIPPED)
+        self.assertEqual(nodes['concat_good'].status, COMPLETED)
+        self.assertCountEqual(done, list(nodes))
+
+    def test_retries(self):
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise Exception('ffmpeg crashed')
+
+        def broken():
+            raise Exception('bad input')
+
+        graph = JobGraph(max_workers=1, retries=2)
+        graph.add('flaky', flaky)
+        graph.add('no_retry', broken, retries=0)
+        nodes = graph.run()
+
+        self.assertEqual((nodes['flaky'].status, nodes['flaky'].attempts), (COMPLETED, 3))
+        self.assertEqual((nodes['no_retry'].status, nodes['no_retry'].attempts), (FAILED, 1))
+
+    def test_unknown_dependency(self):
+        with self.assertRaises(ValueError):
+            JobGraph(max_workers=1).add('concat', lambda: None, deps=('missing',))
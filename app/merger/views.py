@@ -1,10 +1,8 @@
 import os
 import subprocess
-import zipfile
 import shutil
-import io
 from django.conf import settings
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, Http404
 from django.shortcuts import redirect
 from django.contrib import messages
 from django.views.decorators.http import require_POST
@@ -13,12 +11,18 @@ from django.contrib.auth.decorators import login_required
 from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 import logging
-from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from .forms import VideoUploadForm
-import threading
 from hooks.tools.utils import generate_task_id
+from hooks.tools.job_queue import get_queue, ensure_worker_pool
+from hooks.tools.cpu_budget import get_budget
+from hooks.tools.media_probe import probe_media
+from hooks.tools.streaming_zip import zip_response
+from hooks.tools.file_serving import serve_file
+from hooks.tools.task_events import task_event_response
+from hooks.tools.status_cache import get_status, refresh_status
 from .models import MergeTask
+from .job_graph import JobGraph
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -32,11 +36,13 @@ def preprocess_video(input_file, output_file, reference_resolution=None):
         command += ["-vf", f"scale={reference_resolution[0]}:{reference_resolution[1]}:force_original_aspect_ratio=decrease,pad={reference_resolution[0]}:{reference_resolution[1]}:(ow-iw)/2:(oh-ih)/2,format=yuv420p,scale=flags=lanczos"]
     
     # Output to the same format for consistency
-    command += ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", output_file]
+    command += ["-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac"]
     
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    logging.info(result.stdout.decode())
-    logging.error(result.stderr.decode())
+    with get_budget().encode() as threads:
+        command += ["-threads", str(threads), output_file]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to preprocess {input_file}: {result.stderr.decode()}")
     logging.info(f"Finished preprocessing: {output_file}")
 
 # Function to concatenate videos using FFmpeg with re-encoding
@@ -51,34 +57,79 @@ def concatenate_videos(input_files, output_file):
     # Create FFmpeg command with concat protocol
     command = ["ffmpeg", "-y", "-vsync", "2"] + input_args + [
         "-filter_complex", "concat=n={}:v=1:a=1".format(len(input_files)),
-        "-c:v", "libx264", "-preset", "superfast", "-c:a", "aac", output_file
+        "-c:v", "libx264", "-preset", "superfast", "-c:a", "aac"
     ]
         
     # Run the command and log stdout/stderr
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with get_budget().encode() as threads:
+        command += ["-threads", str(threads), output_file]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to concatenate {output_file}: {result.stderr.decode()}")
     logging.info(f"Finished concatenating: {output_file}")
 
 # Function to check the format and resolution of a video file
 def check_video_format_resolution(video_file):
-    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries",
-               "stream=width,height", "-of", "csv=p=0:s=x", video_file]
-    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    output = result.stdout.decode().strip().split('\n')
+    try:
+        media_probe = probe_media(video_file)
+    except Exception as e:
+        logging.error(f"Could not determine resolution for video: {video_file} - {e}")
+        return None, None
+    return media_probe.width, media_probe.height
+
+# Function to read the stream parameters that concatenated files must share
+def probe_stream_params(video_file):
+    return probe_media(video_file).stream_params()
+
+# Function to encode a video with exactly the reference codec parameters, so it can be stream copied
+def normalize_for_concat(input_file, output_file, reference):
+    logging.info(f"Normalizing video for stream copy: {input_file}")
+    width, height = reference['width'], reference['height']
+    media_probe = probe_media(input_file)
+
+    # Every input is encoded, even one whose probe matches: stream copy keeps only the first
+    # part's codec headers (SPS/PPS, AAC config), which the probe does not compare
+    command = ["ffmpeg", "-y", "-i", input_file]
 
-    # Filter out any empty strings or invalid lines
-    resolutions = [line.strip() for line in output if 'x' in line and line.strip()]
-    
-    # Return the first valid resolution found, split into width and height
-    if resolutions:
-        try:
-            width, height = resolutions[0].split('x')[:2]  # Split and only take the first two values
-            return width.strip(), height.strip()
-        except ValueError as e:
-            logging.error(f"Error parsing resolution: {resolutions[0]} - {e}")
-            return None, None
+    # Every part needs an audio track for the concat demuxer, add silence where it is missing
+    if media_probe.has_audio:
+        command += ["-map", "0:v:0", "-map", "0:a:0"]
     else:
-        logging.error(f"Could not determine resolution for video: {video_file}")
-        return None, None  # Or handle the case where no resolution is found
+        command += ["-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=44100",
+                    "-map", "0:v:0", "-map", "1:a:0", "-shortest"]
+
+    command += [
+        "-vf", f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={reference['fps']},format=yuv420p",
+        "-c:v", "libx264", "-preset", "superfast", "-profile:v", "high", "-pix_fmt", "yuv420p",
+        "-video_track_timescale", "90000",
+        "-c:a", "aac", "-ar", "44100", "-ac", "2", "-b:a", "128k",
+    ]
+
+    with get_budget().encode() as threads:
+        command += ["-threads", str(threads), output_file]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to normalize {input_file}: {result.stderr.decode()}")
+    logging.info(f"Finished normalizing: {output_file}")
+    return output_file
+
+# Function to join normalized videos with the concat demuxer, without re-encoding
+def concatenate_videos_copy(input_files, output_file):
+    logging.info(f"Stream copy concatenating videos into: {output_file}")
+    list_file = f"{output_file}.txt"
+    with open(list_file, 'w') as f:
+        for input_file in input_files:
+            escaped_path = os.path.abspath(input_file).replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+
+    command = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_file,
+               "-c", "copy", "-movflags", "+faststart", output_file]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    os.remove(list_file)
+    if result.returncode != 0:
+        raise Exception(f"ffmpeg failed to concatenate {output_file}: {result.stderr.decode()}")
+    logging.info(f"Finished concatenating: {output_file}")
+    return output_file
 
 def process_videos(task_id):
     logging.info("Starting video processing...")
@@ -88,57 +139,89 @@ def process_videos(task_id):
     short_videos = merge_task.short_video_path
     large_videos =merge_task.large_video_paths
 
-    # Use the resolution of the first large video as the reference
-    reference_resolution = check_video_format_resolution(large_videos[0])
-    logging.info(f"Reference resolution for preprocessing: {reference_resolution}")
-
-    # Preprocess short videos to match the large video resolution
-    preprocessed_short_files = []
-    short_video_names = []
-    with ThreadPoolExecutor() as executor:
-        futures = []
-        for video in short_videos:
-            # Extract the name of the short video without extension
-            short_name = os.path.splitext(os.path.basename(video))[0]
-            short_video_names.append(short_name)
-            output_file = os.path.join(settings.OUTPUT_FOLDER, f"preprocessed_{short_name}.mp4")
-            futures.append(executor.submit(preprocess_video, video, output_file, reference_resolution))
-            preprocessed_short_files.append(output_file)
-        for future in futures:
-            future.result()  # wait for all threads to complete
+    # In copy mode every video is encoded once with the first large video's parameters
+    # and each pair is joined without re-encoding, instead of re-encoding every pair
+    copy_mode = settings.MERGER_CONCAT_MODE == 'copy'
+    if copy_mode:
+        reference = probe_stream_params(large_videos[0])
+        logging.info(f"Reference parameters for stream copy: {reference}")
+        prepare_short = partial(normalize_for_concat, reference=reference)
+        concatenate = concatenate_videos_copy
+    else:
+        # Use the resolution of the first large video as the reference
+        reference_resolution = check_video_format_resolution(large_videos[0])
+        logging.info(f"Reference resolution for preprocessing: {reference_resolution}")
+        prepare_short = partial(preprocess_video, reference_resolution=reference_resolution)
+        concatenate = concatenate_videos
+
+    # Every short and large video is prepared once, each pair is concatenated as soon as
+    # both of its inputs are ready. A failed input only fails the pairs that use it
+    graph = JobGraph(settings.MERGER_WORKERS or os.cpu_count() or 1, retries=settings.MERGER_JOB_RETRIES)
+
+    short_jobs = []
+    for video in short_videos:
+        # Extract the name of the short video without extension
+        short_name = os.path.splitext(os.path.basename(video))[0]
+        output_file = os.path.join(settings.OUTPUT_FOLDER, f"preprocessed_{short_name}.mp4")
+        graph.add(f"prepare {short_name}", prepare_short, video, output_file)
+        short_jobs.append((short_name, output_file, f"prepare {short_name}"))
+
+    large_jobs = []
+    for video in large_videos:
+        large_name = os.path.splitext(os.path.basename(video))[0]
+        if copy_mode:
+            # Large videos are normalized once here, not once per short video
+            output_file = os.path.join(settings.OUTPUT_FOLDER, f"normalized_{large_name}.mp4")
+            graph.add(f"prepare {large_name}", normalize_for_concat, video, output_file, reference)
+            large_jobs.append((large_name, output_file, [f"prepare {large_name}"]))
+        else:
+            large_jobs.append((large_name, video, []))
 
+    # Concatenate each large video with each preprocessed short video
     final_output_files = []
+    outputs_by_job = {}
+    for large_name, prepared_large, large_deps in large_jobs:
+        for short_name, prepared_short, short_job in short_jobs:
+            final_output_name = f"{short_name}_{large_name}.mp4"
+            final_output = os.path.join(settings.OUTPUT_FOLDER, final_output_name)
+            job_name = f"concat {final_output_name}"
+            graph.add(job_name, concatenate, [prepared_short, prepared_large], final_output,
+                      deps=[short_job] + large_deps)
+
+            output = {'video_link': final_output, 'file_name': final_output_name,
+                      'status': 'pending', 'seconds': None, 'error': None}
+            final_output_files.append(output)
+            outputs_by_job[job_name] = output
+
+    def record_output(node):
+        # Publish every finished pair so the status endpoint shows per-output progress
+        output = outputs_by_job.get(node.name)
+        if output is None:
+            return
+        output['status'] = node.status
+        output['seconds'] = node.seconds
+        output['error'] = node.error
+        MergeTask.objects.filter(pk=merge_task.pk).update(video_links=final_output_files)
+        refresh_status(MergeTask, task_id)
 
-    # Concatenate each large video with each preprocessed short video
-    with ThreadPoolExecutor() as executor:
-        concat_futures = []
-        for large_video in tqdm(large_videos, desc="Concatenating with large videos"):
-            large_name = os.path.splitext(os.path.basename(large_video))[0]  # Extract the name of the large video without extension
-            for short_video, short_name in zip(preprocessed_short_files, short_video_names):
-                temp_dict = {}
-                final_output_name = f"{short_name}_{large_name}.mp4"
-                final_output = os.path.join(settings.OUTPUT_FOLDER, final_output_name)
-
-                # Submit concatenation task to thread pool
-                concat_futures.append(executor.submit(concatenate_videos, [short_video, large_video], final_output))
-
-                # Store video details
-                video_name = os.path.basename(final_output)
-                temp_dict['video_link'] = final_output
-                temp_dict['file_name'] = video_name
-
-                final_output_files.append(temp_dict)
-        
-        # Wait for all concatenation tasks to complete
-        for future in concat_futures:
-            future.result()  # ensure each concatenation is completed
-    
-    logging.info("Video processing complete!")
-    
-    # Update the merge task status
-    merge_task.status = 'completed'
     merge_task.video_links = final_output_files
-    merge_task.save()
+    merge_task.save(update_fields=['video_links'])
+    graph.run(on_done=record_output)
+
+    completed = [output for output in final_output_files
+                 if output['status'] == 'completed' and os.path.exists(output['video_link'])]
+    logging.info(f"Video processing complete! {len(completed)} of {len(final_output_files)} outputs succeeded")
+
+    # The task only counts as completed when it produced at least one video,
+    # failed pairs stay listed with their error
+    merge_task.status = 'completed' if completed else 'failed'
+    merge_task.video_links = final_output_files
+    merge_task.save(update_fields=['status', 'video_links'])
+    refresh_status(MergeTask, task_id)
+
+def run_merge_task(task):
+    # Job queue handler, runs on a worker instead of the request thread
+    process_videos(task.task_id)
 
 @login_required
 def index(request):
@@ -206,12 +289,12 @@ def processing(request, task_id):
         # return redirect('hooks:no_credits')  # Redirect to an error page or appropriate view
         return HttpResponse("You don't have enough merge credits, buy and try again!", status=404)
     
-    thread = threading.Thread(target=process_videos, args=(task_id,))
-    thread.start()
-
-    user_profile.merge_credits -= merge_credits_used
-    user_profile.save()
-    logging.info(f"Used {merge_credits_used} merge credits")
+    # Credits are only charged the first time the task is queued, not on page reloads
+    if get_queue('merge').enqueue(task_id, user=request.user):
+        user_profile.merge_credits -= merge_credits_used
+        user_profile.save()
+        logging.info(f"Used {merge_credits_used} merge credits")
+    ensure_worker_pool()
 
     return render(request, 
                 'merger/processing.html',
@@ -219,13 +302,18 @@ def processing(request, task_id):
 
 @login_required
 def check_task_status(request, task_id):
-    task = get_object_or_404(MergeTask, task_id=task_id)
-    
-    # Return task status and video links (if processing is completed)
-    return JsonResponse({
-        'status': task.status,
-        'video_links': task.video_links if task.status == 'completed' else None
-    })
+    # Workers keep the cached payload up to date, the database is only read on a miss
+    payload = get_status(MergeTask, task_id)
+    if payload is None:
+        raise Http404("Task not found")
+    return JsonResponse(payload)
+
+@login_required
+def task_events(request, task_id):
+    # Pushes the same payload as check_task_status whenever it changes (ASGI only)
+    if get_status(MergeTask, task_id) is None:
+        raise Http404("Task not found")
+    return task_event_response(request, lambda: get_status(MergeTask, task_id))
 
 @login_required 
 def processing_successful(request, task_id):
@@ -238,19 +326,8 @@ def processing_successful(request, task_id):
 
 @login_required 
 def download_video(request, videopath):
-    # Decode the path
-    # videopath = os.path.join(settings.BASE_DIR.parent, videopath)
-
-    
-    # Check if the video file exists
-    if not os.path.exists(videopath):
-        return HttpResponse("Video not found", status=404)
-
-    # Return the file as a download
-    response = FileResponse(open(videopath, 'rb'), content_type='video/mp4')
-    response['Content-Disposition'] = f'attachment; filename="{os.path.basename(videopath)}"'
-    
-    return response
+    # Ranges, conditional requests and proxy offload are handled by serve_file
+    return serve_file(request, videopath)
 
 @login_required 
 def download_zip(request, task_id):
@@ -258,27 +335,14 @@ def download_zip(request, task_id):
     task = get_object_or_404(MergeTask, task_id=task_id)
     videos = task.video_links
 
-    zip_buffer = io.BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        for idx, video in enumerate(videos):
-            if os.path.exists(video['video_link']):
-                file_name = os.path.basename(video['video_link'])
-
-                # Add the file to the zip archive
-                zip_file.write(video['video_link'], file_name)
-
-    zip_buffer.seek(0)
-
-    # Create a response with the zip file for downloading
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="final_videos.zip"'
-    
-    # Cleanup: Remove uploaded and output files after sending the response
-    shutil.rmtree(settings.UPLOAD_FOLDER, ignore_errors=True)
-    os.makedirs(settings.UPLOAD_FOLDER, exist_ok=True)
-    shutil.rmtree(settings.OUTPUT_FOLDER, ignore_errors=True)
-    os.makedirs(settings.OUTPUT_FOLDER, exist_ok=True)
-            
-    logging.info("Temporary files cleaned up successfully.")
-    return response
\ No newline at end of file
+    def cleanup():
+        # Remove uploaded and output files once the archive was sent
+        shutil.rmtree(settings.UPLOAD_FOLDER, ignore_errors=True)
+        os.makedirs(settings.UPLOAD_FOLDER, exist_ok=True)
+        shutil.rmtree(settings.OUTPUT_FOLDER, ignore_errors=True)
+        os.makedirs(settings.OUTPUT_FOLDER, exist_ok=True)
+        logging.info("Temporary files cleaned up successfully.")
+
+    # Stream the archive as it is written instead of building it in memory first
+    files = [(video['video_link'], os.path.basename(video['video_link'])) for video in videos]
+    return zip_response(files, 'final_videos.zip', on_complete=cleanup)